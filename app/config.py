@@ -50,6 +50,9 @@ class Settings(BaseSettings):
     LOG_LEVEL: str = "INFO"
     LOG_FILE: str = "logs/app.log"
     AUDIT_LOG_FILE: str = "logs/audit.log"
+    WORKERS: int = 8
+    REPORT_WRITER_THREADS: int = 2
+    RENDER_WORKERS: int = 4
 
     DB_PASSWORD: Optional[SecretStr] = Field(default=None)
     BITRIX_PASSWORD: Optional[SecretStr] = Field(default=None)
@@ -1,13 +1,22 @@
+from datetime import datetime
+
 from app.custom_logging import log_call, get_logger
 from app.db.queries import (
-    SQL_PRIMARY_APPTS_TODAY, SQL_MAIN_QUERY, SQL_GET_LAST_OBSLED, SQL_GET_PARAMSINFO,
+    SQL_PRIMARY_APPTS_TODAY, SQL_PRIMARY_APPTS_RANGE, SQL_MAIN_QUERY, SQL_GET_LAST_OBSLED, SQL_GET_PARAMSINFO,
     SQL_GET_TREATMENT_PLAN, SQL_GET_COMPLEX_PLANS, SQL_GET_PLAN_DETAILS,
     SQL_GET_APPROVED_PLANS, SQL_GET_APPROVED_PLANS_PAID, SQL_GET_TREATCODES,
-    SQL_GET_STAGE, SQL_GET_FUTURE_APPOINTMENTS, SQL_GET_SCHEDULE_INFO, SQL_REPEAT_PATIENTS
+    SQL_GET_STAGE, SQL_GET_FUTURE_APPOINTMENTS, SQL_GET_SCHEDULE_INFO, SQL_REPEAT_PATIENTS,
+    SQL_GET_FRESHNESS_TOKEN, SQL_MAIN_QUERY_BULK, SQL_GET_LAST_OBSLED_BULK, SQL_GET_PARAMSINFO_BULK,
+    SQL_GET_TREATMENT_PLAN_BULK, SQL_GET_STAGE_BULK, SQL_GET_FUTURE_APPOINTMENTS_BULK,
+    SQL_GET_COMPLEX_PLANS_BULK, SQL_GET_PLAN_DETAILS_BULK, SQL_GET_APPROVED_PLANS_BULK,
+    SQL_GET_APPROVED_PLANS_PAID_BULK
 )
 
 log = get_logger(__name__)
 
+# Сколько ключей кладём в один IN-список (у Firebird лимит 1500)
+BULK_CHUNK_SIZE = 500
+
 def _fetch_one(conn, sql, params=()):
     cur = conn.cursor()
     cur.execute(sql, params)
@@ -25,15 +34,49 @@ def _fetch_all(conn, sql, params=()):
     return [dict(zip(cols, r)) for r in cur.fetchall()]
 
 
+def normalize_pcode(pcode) -> str:
+    # PCODE как ключ пакетных словарей: в том же виде, в каком его отдаёт БД (" 0123" -> "123");
+    # нечисловой PCODE — ValueError
+    return str(int(str(pcode).strip()))
+
+
+def _fetch_grouped(conn, sql_template, keys) -> dict:
+    # IN-запросы пачками по BULK_CHUNK_SIZE; строки раскладываем по GROUP_KEY (ключ приводим к str)
+    keys = list(keys)
+    grouped = {}
+    for i in range(0, len(keys), BULK_CHUNK_SIZE):
+        chunk = keys[i:i + BULK_CHUNK_SIZE]
+        sql = sql_template.format(placeholders=", ".join("?" * len(chunk)))
+        for row in _fetch_all(conn, sql, tuple(chunk)):
+            grouped.setdefault(str(row.pop("GROUP_KEY")), []).append(row)
+    return grouped
+
+
 @log_call()
 def fetch_primary_patients_today(conn, target_date):
     # пациенты с первичным приёмом на указанную дату
     return _fetch_all(conn, SQL_PRIMARY_APPTS_TODAY, (target_date,))
 
+@log_call()
+def fetch_primary_patients_range(conn, start_date, end_date) -> dict:
+    # первичные приёмы за весь диапазон одним запросом, с разбивкой по дате
+    by_date = {}
+    for row in _fetch_all(conn, SQL_PRIMARY_APPTS_RANGE, (start_date, end_date)):
+        first_date = row.pop("FIRST_DATE")
+        if isinstance(first_date, datetime):
+            first_date = first_date.date()
+        by_date.setdefault(first_date, []).append(row)
+    return by_date
+
 @log_call()
 def fetch_main_info(conn, pcode: str):
     return _fetch_one(conn, SQL_MAIN_QUERY, (pcode,))
 
+@log_call()
+def fetch_main_info_bulk(conn, pcodes) -> dict:
+    # основная информация сразу для пачки пациентов: {pcode: info}; как и в _fetch_one — первая строка
+    return {pcode: rows[0] for pcode, rows in _fetch_grouped(conn, SQL_MAIN_QUERY_BULK, pcodes).items()}
+
 
 @log_call()
 def fetch_last_obslnum(conn, pcode: str):
@@ -65,6 +108,11 @@ def fetch_approved_plans_paid(conn, pcode: str):
 def fetch_repeat_patients(conn):
     return _fetch_all(conn, SQL_REPEAT_PATIENTS)
 
+@log_call()
+def fetch_freshness_token(conn, pcode: str):
+    # одна строка со «следами» всех данных, от которых зависит хеш пациента (см. SQL_GET_FRESHNESS_TOKEN)
+    return _fetch_one(conn, SQL_GET_FRESHNESS_TOKEN, (pcode,))
+
 @log_call()
 def fetch_current_stage(conn, pcode: str):
     treatcodes = _fetch_all(conn, SQL_GET_TREATCODES, (pcode,))
@@ -76,36 +124,74 @@ def fetch_current_stage(conn, pcode: str):
                 stage_value = r["VALUETEXT"]
     return stage_value
 
+def _appointment_status(sched_info) -> str:
+    # приём длиной 1 или 15 минут в расписании означает отмену
+    if sched_info:
+        duration = (sched_info["FHOUR"] * 60 + sched_info["FMIN"]) - (sched_info["BHOUR"] * 60 + sched_info["BMIN"])
+        if duration in (1, 15):
+            return "ОТМЕНЕНО"
+    return "ОЖИДАЕТСЯ"
+
+
+def _enrich_appointment(a, status: str) -> dict:
+    return {
+        # оригинальные ключи для main.py и formatting.py
+        "WORK_DATE_STR": a["WORK_DATE_STR"],
+        "DOCTOR_NAME": a["DOCTOR_NAME"],
+        "FILIAL_NAME": a["FILIAL_NAME"],
+        "SCHEDAPPEALS_COMMENT": a["SCHEDAPPEALS_COMMENT"],
+
+        # «человеческие» ключи для отчёта
+        "Дата": a["WORK_DATE_STR"],
+        "Филиал": a["FILIAL_NAME"],
+        "Доктор": a["DOCTOR_NAME"],
+        "Комментарий": a["SCHEDAPPEALS_COMMENT"],
+        "Статус": status,
+    }
+
+
 @log_call()
 def fetch_future_appointments(conn, pcode: str):
     appointments = _fetch_all(conn, SQL_GET_FUTURE_APPOINTMENTS, (pcode,))
     enriched = []
     for a in appointments:
-        schedid = a["SCHEDID"]
-        sched_info = _fetch_one(conn, SQL_GET_SCHEDULE_INFO, (schedid,))
-        status = "ОЖИДАЕТСЯ"
-        if sched_info:
-            duration = (sched_info["FHOUR"] * 60 + sched_info["FMIN"]) - (sched_info["BHOUR"] * 60 + sched_info["BMIN"])
-            if duration in (1, 15):
-                status = "ОТМЕНЕНО"
-
-        enriched.append({
-            # оригинальные ключи для main.py и formatting.py
-            "WORK_DATE_STR": a["WORK_DATE_STR"],
-            "DOCTOR_NAME": a["DOCTOR_NAME"],
-            "FILIAL_NAME": a["FILIAL_NAME"],
-            "SCHEDAPPEALS_COMMENT": a["SCHEDAPPEALS_COMMENT"],
-
-            # «человеческие» ключи для отчёта
-            "Дата": a["WORK_DATE_STR"],
-            "Филиал": a["FILIAL_NAME"],
-            "Доктор": a["DOCTOR_NAME"],
-            "Комментарий": a["SCHEDAPPEALS_COMMENT"],
-            "Статус": status,
-        })
+        sched_info = _fetch_one(conn, SQL_GET_SCHEDULE_INFO, (a["SCHEDID"],))
+        enriched.append(_enrich_appointment(a, _appointment_status(sched_info)))
 
     return enriched
 
+@log_call()
+def fetch_future_appointments_bulk(conn, pcodes) -> dict:
+    # будущие приёмы сразу для пачки пациентов; длительность берётся из того же запроса (JOIN SCHEDULE)
+    grouped = _fetch_grouped(conn, SQL_GET_FUTURE_APPOINTMENTS_BULK, pcodes)
+    return {
+        pcode: [
+            _enrich_appointment(a, _appointment_status(a if a["BHOUR"] is not None else None))
+            for a in rows
+        ]
+        for pcode, rows in grouped.items()
+    }
+
+
+def _group_approved_plans(approved_plans) -> list:
+    grouped = {}
+    for row in approved_plans:
+        did = row["DID"]
+        if did not in grouped:
+            grouped[did] = {
+                "DEPNAME": row["DEPNAME"],
+                "SUMMARUB": row["SUMMARUB"],
+                "TREATDATE": row["PDATE"],
+                "DOCTOR_NAME": row["DOCTOR_NAME"],
+                "details": []
+            }
+        grouped[did]["details"].append({
+            "SCHNAME": row["SCHNAME"],
+            "SCOUNT": row["SCOUNT"],
+            "AMOUNTRUB": row["AMOUNTRUB"],
+        })
+    return list(grouped.values())
+
 @log_call()
 def collect_patient_data(conn, pcode: str) -> dict:
     result = {}
@@ -143,23 +229,7 @@ def collect_patient_data(conn, pcode: str) -> dict:
 
     # Согласованные планы
     approved_plans = fetch_approved_plans(conn, pcode)
-    grouped = {}
-    for row in approved_plans:
-        did = row["DID"]
-        if did not in grouped:
-            grouped[did] = {
-                "DEPNAME": row["DEPNAME"],
-                "SUMMARUB": row["SUMMARUB"],
-                "TREATDATE": row["PDATE"],
-                "DOCTOR_NAME": row["DOCTOR_NAME"],
-                "details": []
-            }
-        grouped[did]["details"].append({
-            "SCHNAME": row["SCHNAME"],
-            "SCOUNT": row["SCOUNT"],
-            "AMOUNTRUB": row["AMOUNTRUB"],
-        })
-    result["approved_plans"] = list(grouped.values())
+    result["approved_plans"] = _group_approved_plans(approved_plans)
 
     # Общая оплаченная сумма (BALANCEAMOUNT)
     result["approved_plans_paid"] = fetch_approved_plans_paid(conn, pcode)
@@ -167,3 +237,76 @@ def collect_patient_data(conn, pcode: str) -> dict:
     result["future_appointments"] = fetch_future_appointments(conn, pcode)
 
     return result
+
+
+@log_call()
+def collect_patient_data_bulk(conn, pcodes) -> dict:
+    # То же, что collect_patient_data, но для пачки пациентов: каждая таблица читается
+    # IN-запросами, а строки раскладываются по пациентам в Python
+    pcodes = list(dict.fromkeys(normalize_pcode(p) for p in pcodes))
+    if not pcodes:
+        return {}
+
+    infos = fetch_main_info_bulk(conn, pcodes)
+
+    obsleds = _fetch_grouped(conn, SQL_GET_LAST_OBSLED_BULK, pcodes)
+    last_obslnums = {pcode: rows[0]["OBSLNUM"] for pcode, rows in obsleds.items()}
+    params = _fetch_grouped(
+        conn, SQL_GET_PARAMSINFO_BULK, {n for n in last_obslnums.values() if n is not None}
+    )
+
+    composite = _fetch_grouped(conn, SQL_GET_TREATMENT_PLAN_BULK, pcodes)
+    stages = _fetch_grouped(conn, SQL_GET_STAGE_BULK, pcodes)
+    appointments = fetch_future_appointments_bulk(conn, pcodes)
+
+    complex_plans = _fetch_grouped(conn, SQL_GET_COMPLEX_PLANS_BULK, pcodes)
+    plan_details = _fetch_grouped(
+        conn, SQL_GET_PLAN_DETAILS_BULK, {cp["DID"] for rows in complex_plans.values() for cp in rows}
+    )
+
+    approved = _fetch_grouped(conn, SQL_GET_APPROVED_PLANS_BULK, pcodes)
+    paid = _fetch_grouped(conn, SQL_GET_APPROVED_PLANS_PAID_BULK, pcodes)
+
+    results = {}
+    for pcode in pcodes:
+        result = {}
+        result["info"] = infos.get(pcode)
+
+        if pcode in last_obslnums:
+            obslnum = last_obslnums[pcode]
+            result["last_obslnum"] = obslnum
+            result["params"] = params.get(str(obslnum), [])
+        else:
+            result["last_obslnum"] = None
+            result["params"] = []
+
+        result["composite_plan"] = composite.get(pcode, [])
+
+        # как в fetch_current_stage: последнее непустое значение по возрастанию TREATCODE
+        stage_value = None
+        for r in stages.get(pcode, []):
+            if r["VALUETEXT"]:
+                stage_value = r["VALUETEXT"]
+        result["current_stage"] = stage_value
+
+        patient_appts = appointments.get(pcode, [])
+        result["appointments"] = patient_appts
+
+        enriched_complex_plans = []
+        for cp in complex_plans.get(pcode, []):
+            cp_copy = cp.copy()
+            cp_copy["details"] = plan_details.get(str(cp["DID"]), [])
+            enriched_complex_plans.append(cp_copy)
+        result["complex_plans"] = enriched_complex_plans
+
+        result["approved_plans"] = _group_approved_plans(approved.get(pcode, []))
+
+        paid_rows = paid.get(pcode)
+        paid_sum = paid_rows[0]["PAID_SUM"] if paid_rows else None
+        result["approved_plans_paid"] = paid_sum if paid_sum is not None else 0
+
+        result["future_appointments"] = [dict(a) for a in patient_appts]
+
+        results[pcode] = result
+
+    return results
@@ -0,0 +1,37 @@
+from __future__ import annotations
+import queue
+from contextlib import ExitStack, contextmanager
+
+from app.custom_logging import get_logger
+
+log = get_logger(__name__)
+
+
+@contextmanager
+def connection_pool(settings, size: int):
+    # Очередь из size отдельных соединений: одно соединение fdb нельзя делить между потоками
+    from app.db.client import get_connection
+
+    with ExitStack() as stack:
+        pool: queue.Queue = queue.Queue()
+        for _ in range(size):
+            pool.put(stack.enter_context(get_connection(settings)))
+        log.info(f"Открыт пул соединений с БД: {size}")
+        yield pool
+
+
+def shared_connection_pool(conn) -> queue.Queue:
+    # «Пул» из одного уже открытого соединения — для последовательной обработки без лишних подключений
+    pool: queue.Queue = queue.Queue()
+    pool.put(conn)
+    return pool
+
+
+@contextmanager
+def pooled_connection(pool: queue.Queue):
+    # Берём свободное соединение на время задачи и возвращаем его в пул
+    conn = pool.get()
+    try:
+        yield conn
+    finally:
+        pool.put(conn)
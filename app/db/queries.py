@@ -184,6 +184,32 @@ LEFT JOIN DOCTOR d_cons
 WHERE CAST(f.FIRSTWORKDATE AS DATE) = ?;
 """
 
+SQL_PRIMARY_APPTS_RANGE = """
+SELECT
+    c.PCODE,
+    c.LASTNAME,
+    c.FIRSTNAME,
+    c.MIDNAME,
+    c.BDATE,
+    d_cons.DNAME AS CONSULT_DOCTOR,
+    f.FIRSTWORKDATE AS FirstWorkDate,
+    CAST(f.FIRSTWORKDATE AS DATE) AS FIRST_DATE
+FROM CLIENTS c
+JOIN (
+    SELECT
+        r.PCODE,
+        MIN(r.SCHEDULE_WORKDATE) AS FIRSTWORKDATE
+    FROM REP_SCHED_APPEALS_VIEW r
+    JOIN SCHEDULE s ON s.SCHEDID = r.SCHEDID
+    WHERE ((s.FHOUR * 60 + s.FMIN) - (s.BHOUR * 60 + s.BMIN)) > 15
+    GROUP BY r.PCODE
+) f
+  ON f.PCODE = c.PCODE
+LEFT JOIN DOCTOR d_cons
+  ON d_cons.DCODE = c.DCODE_CONSULT
+WHERE CAST(f.FIRSTWORKDATE AS DATE) BETWEEN ? AND ?;
+"""
+
 SQL_GET_APPROVED_PLANS_PAID = """
 SELECT CAST(COALESCE(SUM(p.BALANCEAMOUNT), 0) AS DOUBLE PRECISION) AS PAID_SUM
 FROM PAYLOG p
@@ -234,5 +260,210 @@ LEFT JOIN CLSTATUS cls ON cls.SID = c.AGESTATUS
 WHERE cls.SNAME = 'Повторный пациент под кураторством'
 """
 
+# Токен свежести: одна строка, которая меняется вместе с любым полем, попадающим в хеш пациента.
+# Наборы строк (приёмы, этапы, первый визит) сворачиваются в SUM(MOD(HASH(строка), 1000000007)) + COUNT:
+# от порядка строк не зависит и не переполняет BIGINT. Значения собираются теми же JOIN, что и в выгрузке
+SQL_GET_FRESHNESS_TOKEN = """
+SELECT
+    c.LASTNAME,
+    c.FIRSTNAME,
+    c.MIDNAME,
+    c.DCODE_CONSULT,
+    (SELECT d.DNAME FROM DOCTOR d WHERE d.DCODE = c.DCODE_CONSULT) AS CONSULT_DOCTOR,
+    c.AGESTATUS,
+    c.TYPESTATUS,
+    (SELECT cls.SNAME FROM CLSTATUS cls WHERE cls.SID = c.AGESTATUS) AS AGESTATUS_NAME,
+    (SELECT cls.SNAME FROM CLSTATUS cls WHERE cls.SID = c.TYPESTATUS) AS TYPESTATUS_NAME,
+    (SELECT COUNT(*) FROM REP_SCHED_APPEALS_VIEW r
+      WHERE r.PCODE = c.PCODE) AS APPT_COUNT,
+    (SELECT MAX(r.SCHEDULE_WORKDATE) FROM REP_SCHED_APPEALS_VIEW r
+      WHERE r.PCODE = c.PCODE) AS LAST_APPT,
+    (SELECT COUNT(*)
+       FROM REP_SCHED_APPEALS_VIEW r
+       JOIN SCHEDULE s ON s.SCHEDID = r.SCHEDID
+      WHERE r.PCODE = c.PCODE
+        AND ((s.FHOUR * 60 + s.FMIN) - (s.BHOUR * 60 + s.BMIN)) > 15) AS VISIT_COUNT,
+    (SELECT COUNT(*) || ':' || SUM(MOD(HASH(
+                r.SCHEDULE_WORKDATE || '|' || COALESCE(r.DCODE, -1) || '|' || COALESCE(d.DNAME, '') || '|'
+                || COALESCE(fil.FULLNAME, '') || '|' || COALESCE(s.STATUS, -1)
+            ), 1000000007))
+       FROM REP_SCHED_APPEALS_VIEW r
+       JOIN SCHEDULE s ON s.SCHEDID = r.SCHEDID
+       LEFT JOIN DOCTOR d ON d.DCODE = r.DCODE
+       LEFT JOIN FILIALS fil ON fil.FILID = r.SCHEDFILIAL
+      WHERE r.PCODE = c.PCODE
+        AND r.SCHEDULE_WORKDATE = (
+            SELECT MIN(r2.SCHEDULE_WORKDATE)
+              FROM REP_SCHED_APPEALS_VIEW r2
+              JOIN SCHEDULE s2 ON s2.SCHEDID = r2.SCHEDID
+             WHERE r2.PCODE = c.PCODE
+               AND ((s2.FHOUR * 60 + s2.FMIN) - (s2.BHOUR * 60 + s2.BMIN)) > 15
+        )) AS FIRST_VISIT_HASH,
+    (SELECT COUNT(*) || ':' || SUM(MOD(HASH(
+                r.SCHEDID || '|' || r.SCHEDULE_WORKDATE || '|' || COALESCE(d.DNAME, '') || '|'
+                || COALESCE(f.FULLNAME, '') || '|' || COALESCE(r.SCHEDAPPEALS_COMMENT, '') || '|'
+                || COALESCE((s.FHOUR * 60 + s.FMIN) - (s.BHOUR * 60 + s.BMIN), -1)
+            ), 1000000007))
+       FROM REP_SCHED_APPEALS_VIEW r
+       LEFT JOIN DOCTOR d ON d.DCODE = r.DCODE
+       LEFT JOIN FILIALS f ON f.FILID = r.SCHEDFILIAL
+       LEFT JOIN SCHEDULE s ON s.SCHEDID = r.SCHEDID
+      WHERE r.PCODE = c.PCODE AND r.SCHEDULE_WORKDATE > CURRENT_DATE) AS FUTURE_APPTS_HASH,
+    (SELECT COUNT(*) FROM DAILYPLAN dp
+      WHERE dp.PCODE = c.PCODE) AS PLAN_COUNT,
+    (SELECT MAX(dp.DID) FROM DAILYPLAN dp
+      WHERE dp.PCODE = c.PCODE) AS LAST_PLAN,
+    (SELECT SUM(dpd.SCOUNT * ROUND(dpd.AMOUNTRUB))
+       FROM DAILYPLAN dp
+       JOIN DAILYPLANREF dpr ON dpr.PLANTYPE = dp.PLANTYPE
+       JOIN DAILYPLANDET dpd ON dpd.DID = dp.DID
+       JOIN WSCHEMA ws ON ws.SCHID = dpd.SCHID
+      WHERE dp.PCODE = c.PCODE
+        AND dp.PLANTYPE IN (1, 2)) AS COMPLEX_PLANS_SUM,
+    (SELECT SUM(dpd.SCOUNT * dpd.AMOUNTRUB)
+       FROM DAILYPLAN dp
+       JOIN DAILYPLANREF dpr ON dpr.PLANTYPE = dp.PLANTYPE
+       JOIN DAILYPLANDET dpd ON dpd.DID = dp.DID
+      WHERE dp.PCODE = c.PCODE
+        AND dp.PLANTYPE = 6296) AS APPROVED_PLANS_SUM,
+    (SELECT COUNT(*) FROM PAYLOG p
+      WHERE p.PCODE = c.PCODE) AS PAY_COUNT,
+    (SELECT SUM(p.BALANCEAMOUNT) FROM PAYLOG p
+      WHERE p.PCODE = c.PCODE) AS PAY_SUM,
+    (SELECT COUNT(*) || ':' || SUM(MOD(HASH(pi.TREATCODE || '|' || COALESCE(pi.VALUETEXT, '')), 1000000007))
+       FROM TREAT t
+       JOIN PARAMSINFO pi ON pi.TREATCODE = t.TREATCODE
+       JOIN GROUPSPARAMS gp ON gp.CODEPARAMS = pi.CODEPARAMS
+      WHERE t.PCODE = c.PCODE
+        AND gp.NAMEPARAMS LIKE 'Следующий этап%') AS STAGE_HASH
+FROM CLIENTS c
+WHERE c.PCODE = ?
+"""
+
+# --- Пакетные варианты: {placeholders} подставляется список "?, ?, ..." для IN ---
+# GROUP_KEY — ключ, по которому строки раскладываются по пациентам/планам в Python
+
+SQL_MAIN_QUERY_BULK = (
+    SQL_MAIN_QUERY
+    .replace("SELECT\n    c.PCODE,", "SELECT\n    c.PCODE AS GROUP_KEY,\n    c.PCODE,", 1)
+    .replace("WHERE c.PCODE = ?", "WHERE c.PCODE IN ({placeholders})")
+)
+
+SQL_GET_LAST_OBSLED_BULK = """
+SELECT PCODE AS GROUP_KEY, OBSLNUM
+FROM OBSLED
+WHERE PCODE IN ({placeholders})
+ORDER BY PCODE, OBSLDATE DESC
+"""
 
+SQL_GET_PARAMSINFO_BULK = """
+SELECT
+    pi.TREATCODE AS GROUP_KEY,
+    gp.NAMEPARAMS,
+    pi.VALUETEXT
+FROM PARAMSINFO pi
+JOIN GROUPSPARAMS gp ON gp.CODEPARAMS = pi.CODEPARAMS
+WHERE pi.TREATCODE IN ({placeholders})
+"""
+
+SQL_GET_TREATMENT_PLAN_BULK = """
+SELECT
+    dp.PCODE AS GROUP_KEY,
+    ws.SCHNAME || ' (' || dpd.SCOUNT || ' шт., ' || ROUND(dpd.AMOUNTRUB) || ' руб.)' AS CONCATENATION
+FROM DAILYPLAN dp
+JOIN DAILYPLANDET dpd ON dp.DID = dpd.DID
+JOIN WSCHEMA ws ON dpd.SCHID = ws.SCHID
+WHERE dp.PCODE IN ({placeholders})
+ORDER BY dp.PCODE, ws.SCHNAME
+"""
+
+SQL_GET_STAGE_BULK = """
+SELECT
+    t.PCODE AS GROUP_KEY,
+    pi.VALUETEXT
+FROM TREAT t
+JOIN PARAMSINFO pi ON pi.TREATCODE = t.TREATCODE
+JOIN GROUPSPARAMS gp ON gp.CODEPARAMS = pi.CODEPARAMS
+WHERE t.PCODE IN ({placeholders})
+  AND gp.NAMEPARAMS LIKE 'Следующий этап%'
+ORDER BY t.PCODE, t.TREATCODE
+"""
 
+SQL_GET_FUTURE_APPOINTMENTS_BULK = """
+SELECT
+    r.PCODE AS GROUP_KEY,
+    r.PCODE,
+    r.SCHEDID,
+    CAST(r.SCHEDULE_WORKDATE AS VARCHAR(10)) AS WORK_DATE_STR,
+    d.DNAME AS DOCTOR_NAME,
+    f.FULLNAME AS FILIAL_NAME,
+    r.SCHEDAPPEALS_COMMENT,
+    s.BHOUR, s.BMIN, s.FHOUR, s.FMIN
+FROM REP_SCHED_APPEALS_VIEW r
+LEFT JOIN DOCTOR d ON d.DCODE = r.DCODE
+LEFT JOIN FILIALS f ON f.FILID = r.SCHEDFILIAL
+LEFT JOIN SCHEDULE s ON s.SCHEDID = r.SCHEDID
+WHERE r.PCODE IN ({placeholders})
+  AND r.SCHEDULE_WORKDATE > CURRENT_DATE
+ORDER BY r.PCODE, r.SCHEDULE_WORKDATE
+"""
+
+SQL_GET_COMPLEX_PLANS_BULK = """
+SELECT
+    dp.PCODE AS GROUP_KEY,
+    dp.DID,
+    dp.DEPNUM,
+    dpt.DEPNAME,
+    dpr.PLANTYPENAME,
+    dp.PLANTYPE
+FROM DAILYPLAN dp
+LEFT JOIN DEPARTMENTS dpt ON dpt.DEPNUM = dp.DEPNUM
+JOIN DAILYPLANREF dpr ON dp.PLANTYPE = dpr.PLANTYPE
+WHERE dp.PCODE IN ({placeholders})
+  AND dp.PLANTYPE IN (1, 2)
+ORDER BY dp.PCODE, dp.DID
+"""
+
+SQL_GET_PLAN_DETAILS_BULK = """
+SELECT
+    dpd.DID AS GROUP_KEY,
+    ws.SCHNAME,
+    dpd.SCOUNT,
+    ROUND(dpd.AMOUNTRUB)
+FROM DAILYPLANDET dpd
+JOIN WSCHEMA ws ON dpd.SCHID = ws.SCHID
+WHERE dpd.DID IN ({placeholders})
+ORDER BY dpd.DID, ws.SCHNAME
+"""
+
+SQL_GET_APPROVED_PLANS_BULK = """
+SELECT
+    dp.PCODE AS GROUP_KEY,
+    dp.DID,
+    dpt.DEPNAME,
+    dp.SUMMARUB,
+    dpd.SCHID,
+    wsch.SCHNAME,
+    dpd.SCOUNT,
+    dpd.AMOUNTRUB,
+    dp.PDATE,
+    d.DNAME AS DOCTOR_NAME
+FROM DAILYPLAN dp
+LEFT JOIN DEPARTMENTS dpt ON dpt.DEPNUM = dp.DEPNUM
+LEFT JOIN DAILYPLANDET dpd ON dpd.DID = dp.DID
+LEFT JOIN WSCHEMA wsch ON wsch.SCHID = dpd.SCHID
+JOIN DAILYPLANREF dpr ON dp.PLANTYPE = dpr.PLANTYPE
+LEFT JOIN DOCTOR d ON d.DCODE = dp.DCODE
+WHERE dp.PCODE IN ({placeholders})
+  AND dp.PLANTYPE = 6296
+ORDER BY dp.PCODE, dp.PDATE, dp.DID
+"""
+
+SQL_GET_APPROVED_PLANS_PAID_BULK = """
+SELECT
+    p.PCODE AS GROUP_KEY,
+    CAST(COALESCE(SUM(p.BALANCEAMOUNT), 0) AS DOUBLE PRECISION) AS PAID_SUM
+FROM PAYLOG p
+WHERE p.PCODE IN ({placeholders})
+GROUP BY p.PCODE
+"""
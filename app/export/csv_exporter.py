@@ -9,13 +9,18 @@ from openpyxl.utils import get_column_letter
 from decimal import Decimal, ROUND_HALF_UP
 
 from app.custom_logging import get_logger
-from app.db.extract import collect_patient_data
+from app.db.extract import (
+    collect_patient_data, collect_patient_data_bulk, fetch_main_info, fetch_main_info_bulk,
+    normalize_pcode,
+)
 from app.utils.formatting import format_patient_data
 
 log = get_logger(__name__)
 
 CSV_ENCODING = "cp1251"
 CSV_DELIMITER = ";"
+CSV_BUFFER_SIZE = 1 << 20
+EXPORT_CHUNK_SIZE = 1000
 
 CSV_HEADERS = [
     "Название лида", "Фамилия", "Имя", "Отчество", "Возраст пациента",
@@ -162,8 +167,8 @@ def convert_patient_data_to_csv_row(data: Dict[str, Any]) -> Dict[str, Any]:
             break
 
     # Стоимости и процент выполнения
-    prelim_cost = sum(plan.get("Итого", 0) for plan in data.get("Комплексные планы", []))
-    approved_cost = sum(plan.get("Итого", 0) for plan in data.get("Согласованные планы", []))
+    prelim_cost = data.get("Стоимость комплексных планов", 0)
+    approved_cost = data.get("Стоимость согласованных планов", 0)
     paid_amount = data.get("Общая оплаченная сумма по согласованным планам", 0)
     plan_percent_value = (Decimal(paid_amount) / Decimal(prelim_cost) * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP) if prelim_cost else Decimal(0)
 
@@ -216,6 +221,55 @@ def convert_patient_data_to_csv_row(data: Dict[str, Any]) -> Dict[str, Any]:
     }
 
 
+# Отдаёт (pcode, форматированные данные) по одному пациенту; данные порции EXPORT_CHUNK_SIZE
+# собираются пакетными IN-запросами, при их ошибке — по одному
+def _iter_formatted_patients(conn, patient_pcodes: List[str], verbose: bool = False):
+    for start in range(0, len(patient_pcodes), EXPORT_CHUNK_SIZE):
+        chunk = patient_pcodes[start:start + EXPORT_CHUNK_SIZE]
+        try:
+            bulk = collect_patient_data_bulk(conn, chunk)
+        except Exception as e:
+            log.error(f"Пакетная выгрузка данных не удалась, собираем по одному: {e}")
+            bulk = {}
+        for pcode in chunk:
+            try:
+                if verbose:
+                    log.info(f"Обрабатываем пациента {pcode}")
+                data = bulk.get(normalize_pcode(pcode))
+                if data is None:
+                    data = collect_patient_data(conn, pcode)
+                yield pcode, format_patient_data(data)
+            except Exception as e:
+                log.error(f"Ошибка при обработке {pcode}: {e}")
+
+
+# Персональным данным нужна только основная информация: один пакетный запрос на порцию вместо полного сбора,
+# при его ошибке — по одному, чтобы сбой терял одного пациента, а не всю порцию
+def _iter_personal_patients(conn, patient_pcodes: List[str]):
+    for start in range(0, len(patient_pcodes), EXPORT_CHUNK_SIZE):
+        chunk = patient_pcodes[start:start + EXPORT_CHUNK_SIZE]
+        try:
+            infos = fetch_main_info_bulk(conn, chunk)
+        except Exception as e:
+            log.error(f"Пакетная выгрузка персональных данных не удалась, собираем по одному: {e}")
+            infos = None
+        for pcode in chunk:
+            try:
+                key = normalize_pcode(pcode)
+                info = infos.get(key) if infos is not None else fetch_main_info(conn, key)
+                yield pcode, format_patient_data({"info": info})
+            except Exception as e:
+                log.error(f"Ошибка при обработке {pcode}: {e}")
+
+
+def _csv_safe(row: Dict[str, Any]) -> Dict[str, Any]:
+    r = dict(row)
+    v = r.get("Дата первого визита")
+    if isinstance(v, (date, datetime)):
+        r["Дата первого визита"] = v.strftime("%d.%m.%Y")
+    return r
+
+
 # Создаёт processed_patients.csv, processed_patients.xlsx и обновляет Управленческий отчёт
 def export_patients_to_csv(conn, patient_pcodes: List[str], output_file: Path) -> bool:
     try:
@@ -233,41 +287,34 @@ def export_patients_to_csv(conn, patient_pcodes: List[str], output_file: Path) -
                 except Exception as e:
                     log.warning(f"Не удалось удалить старый файл {old_file}: {e}")
 
+        # CSV пишется потоково по мере обработки пациентов (каждый раз заново);
+        # строки остаются только для Excel-листов, которым нужен весь набор
+        wb = Workbook()
+        ws = wb.active
+        ws.title = "Отчёт"
+        ws.append(CSV_HEADERS)
+
         csv_rows = []
-        for pcode in patient_pcodes:
-            try:
-                log.info(f"Обрабатываем пациента {pcode}")
-                data = format_patient_data(collect_patient_data(conn, pcode))
-                csv_rows.append(convert_patient_data_to_csv_row(data))
-            except Exception as e:
-                log.error(f"Ошибка при обработке {pcode}: {e}")
+        with open(csv_path, "w", newline="", encoding=CSV_ENCODING, buffering=CSV_BUFFER_SIZE) as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_HEADERS, delimiter=CSV_DELIMITER)
+            writer.writeheader()
+            for pcode, data in _iter_formatted_patients(conn, patient_pcodes, verbose=True):
+                try:
+                    row = convert_patient_data_to_csv_row(data)
+                except Exception as e:
+                    log.error(f"Ошибка при обработке {pcode}: {e}")
+                    continue
+                writer.writerow(_csv_safe(row))
+                ws.append([row.get(h, "") for h in CSV_HEADERS])
+                csv_rows.append(row)
 
         if not csv_rows:
+            csv_path.unlink(missing_ok=True)
             log.warning("Нет данных для экспорта пациентов.")
             return False
-
-        # CSV (каждый раз заново)
-        def _csv_safe(row: Dict[str, Any]) -> Dict[str, Any]:
-            r = dict(row)
-            v = r.get("Дата первого визита")
-            if isinstance(v, (date, datetime)):
-                r["Дата первого визита"] = v.strftime("%d.%m.%Y")
-            return r
-
-        with open(csv_path, "w", newline="", encoding=CSV_ENCODING) as f:
-            writer = csv.DictWriter(f, fieldnames=CSV_HEADERS, delimiter=CSV_DELIMITER)
-            writer.writeheader()
-            for row in csv_rows:
-                writer.writerow(_csv_safe(row))
         log.info(f"Создан новый CSV-файл: {csv_path}")
 
         # Excel (каждый раз заново)
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Отчёт"
-        ws.append(CSV_HEADERS)
-        for row in csv_rows:
-            ws.append([row.get(h, "") for h in CSV_HEADERS])
         format_excel_sheet(ws)
         wb.save(excel_path)
         log.info(f"Создан новый Excel-файл: {excel_path}")
@@ -287,29 +334,23 @@ def export_personal_data_to_csv(conn, patient_pcodes: List[str], output_file: Pa
     try:
         output_file = output_file.with_suffix(".csv")
         output_file.parent.mkdir(parents=True, exist_ok=True)
-        csv_rows = []
-
-        for pcode in patient_pcodes:
-            try:
-                raw = collect_patient_data(conn, pcode)
-                data = format_patient_data(raw)
-                csv_rows.append({
-                    "Фамилия": data.get("Фамилия", "—"),
-                    "Имя": data.get("Имя", "—"),
-                    "Отчество": data.get("Отчество", "—"),
-                    "Дата рождения": format_date_str(data.get("Дата рождения")),
-                    "Телефон": data.get("Телефон", "—"),
-                    "Email": data.get("Email", "—"),
-                    "Адрес": data.get("Адрес", "—"),
-                })
-            except Exception as e:
-                log.error(f"Ошибка при обработке {pcode}: {e}")
-                continue
 
-        with open(output_file, "w", newline="", encoding=CSV_ENCODING) as f:
+        with open(output_file, "w", newline="", encoding=CSV_ENCODING, buffering=CSV_BUFFER_SIZE) as f:
             writer = csv.DictWriter(f, fieldnames=headers, delimiter=CSV_DELIMITER)
             writer.writeheader()
-            writer.writerows(csv_rows)
+            for pcode, data in _iter_personal_patients(conn, patient_pcodes):
+                try:
+                    writer.writerow({
+                        "Фамилия": data.get("Фамилия", "—"),
+                        "Имя": data.get("Имя", "—"),
+                        "Отчество": data.get("Отчество", "—"),
+                        "Дата рождения": format_date_str(data.get("Дата рождения")),
+                        "Телефон": data.get("Телефон", "—"),
+                        "Email": data.get("Email", "—"),
+                        "Адрес": data.get("Адрес", "—"),
+                    })
+                except Exception as e:
+                    log.error(f"Ошибка при обработке {pcode}: {e}")
 
         log.info(f"Создан CSV с персональными данными: {output_file}")
         return True
@@ -1,128 +1,513 @@
 from __future__ import annotations
 
-import json
+import os
 import argparse
 import hashlib
+import json
+import multiprocessing
+import struct
+import threading
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
 from datetime import date, datetime, timedelta
 from pathlib import Path
 from typing import List
 
+try:
+    import orjson
+except ImportError:  # без orjson работает стандартный json — тот же формат, только медленнее
+    orjson = None
+
+try:
+    import xxhash
+except ImportError:  # без xxhash хешируем blake2b; алгоритм пишется в known рядом с хешем
+    xxhash = None
+
 from app.config import load_non_secret_env, Settings
 from app.custom_logging import setup_logging, get_logger, patient_log, stage_log
-from app.db.client import get_connection
+from app.db.pool import connection_pool, pooled_connection, shared_connection_pool
 from app.db.extract import (
-    fetch_primary_patients_today,
-    fetch_future_appointments,
-    fetch_main_info,
+    fetch_primary_patients_range,
+    fetch_main_info_bulk,
+    fetch_freshness_token,
     collect_patient_data,
-    fetch_repeat_patients
+    collect_patient_data_bulk,
+    fetch_repeat_patients,
+    normalize_pcode,
 )
 from app.utils.formatting import format_patient_data
-from app.reports.patient_report import build_patient_report
-from app.export.csv_exporter import export_patients_to_csv, export_personal_data_to_csv
+from app.reports.batch_writer import BatchWriter, link_or_copy, write_atomic
 
 BASE_DIR = Path(__file__).resolve().parent
 ENV_PATH = BASE_DIR / ".env"
-load_non_secret_env(str(ENV_PATH))
-settings = Settings()
-setup_logging(
-    level=getattr(settings, "LOG_LEVEL", "INFO"),
-    log_file=getattr(settings, "LOG_FILE", "logs/app.log"),
-    audit_log_file=getattr(settings, "AUDIT_LOG_FILE", "logs/audit.log"),
-)
+# Заполняется в init_app(): процессы рендера заново импортируют этот модуль (spawn),
+# и при импорте не должно быть побочных эффектов — ни чтения настроек, ни открытия файлов логов
+settings: Settings | None = None
 log = get_logger(__name__)
 
 DATA_FILE = Path("known_patients.json")
+JOURNAL_FILE = Path("known_patients.journal.jsonl")
 PDF_DIR = Path("output") / "reports"
-PDF_DIR.mkdir(parents=True, exist_ok=True)
+# Готовые PDF по содержимому: одинаковые данные — один рендер, пациентский файл — жёсткая ссылка
+REPORT_CACHE_DIR = PDF_DIR / "_by_hash"
+REPORT_CACHE_TTL = timedelta(days=30)
 
+# Сколько доверяем «токену свежести» без полной сверки хеша
+FRESHNESS_TOKEN_TTL = timedelta(days=7)
+# Версия состава токена: меняется вместе с SQL_GET_FRESHNESS_TOKEN. Токены прежних версий не покрывали
+# все поля хеша — по ним пропускать сбор данных нельзя
+FRESHNESS_TOKEN_VERSION = 2
 
-def _serialize_value(value):
-    if value is None:
+# Чекпоинты known пишутся компактно; отступы — только для отладки (DEBUG_JSON_INDENT=1)
+_KNOWN_JSON_INDENT = os.getenv("DEBUG_JSON_INDENT", "0") in ("1", "true", "True")
+
+# Дайджест known_patients.json на момент загрузки (или последней записи): совпавшее содержимое не переписываем
+_loaded_digest: bytes | None = None
+
+# PCODE, чьи записи в known изменились с последней записи в журнал
+_dirty: set[str] = set()
+
+# known и _dirty меняются из потоков пула; сами изменения — дешёвые операции со словарём
+_known_lock = threading.Lock()
+
+# Отформатированные данные пациента на время его обработки: {pcode: (исходные данные, formatted)}.
+# Храним сам объект и сравниваем через is — id() освобождённого словаря может достаться новому
+_format_cache: dict[str, tuple[dict, dict]] = {}
+
+# Память _parse_known_date: freshness_checked и старые строковые last_checked у тысяч пациентов — одни и те же строки
+_parsed_known_dates: dict[str, date] = {}
+
+
+def _parse_known_date(value: str | None) -> date | None:
+    # date.fromisoformat в разы быстрее strptime; None — пусто или не дата
+    if not value:
         return None
-    if isinstance(value, (datetime, date)):
-        return str(value)
-    if isinstance(value, (int, float, str, bool)):
+    parsed = _parsed_known_dates.get(value)
+    if parsed is None:
+        try:
+            parsed = date.fromisoformat(value)
+        except (TypeError, ValueError):
+            return None
+        _parsed_known_dates[value] = parsed
+    return parsed
+
+
+def _parse_ddmmyyyy(value: str) -> date:
+    # dd.MM.yyyy из командной строки без strptime (тот лениво импортирует _strptime); ошибки — ValueError.
+    # Формат проверяем строго: int() пропустил бы "24" как год 0024 и "1_0" как 10
+    parts = value.split(".")
+    if len(value) != 10 or [len(p) for p in parts] != [2, 2, 4] or not all(p.isascii() and p.isdigit() for p in parts):
+        raise ValueError(f"ожидается дата dd.MM.yyyy: {value!r}")
+    day, month, year = parts
+    return date(int(year), int(month), int(day))
+
+
+def _json_dumps(obj, *, sort_keys: bool = False, indent: bool = False) -> bytes:
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option)
+    text = json.dumps(
+        obj, ensure_ascii=False, sort_keys=sort_keys,
+        indent=2 if indent else None, separators=None if indent else (",", ":"),
+    )
+    return text.encode("utf-8")
+
+
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+
+# Значения, которые уходят в токен как есть: проверка по множеству без вызова обработчика
+_PASSTHROUGH_TYPES = frozenset({type(None), int, float, str, bool})
+
+# Точное совпадение type() — один поиск в словаре вместо цепочки isinstance; остальное → str
+_SERIALIZERS = {
+    datetime: str,
+    date: str,
+}
+
+
+def _serialize_value(value):
+    value_type = type(value)
+    if value_type in _PASSTHROUGH_TYPES:
         return value
-    return str(value)
+    return _SERIALIZERS.get(value_type, str)(value)
+
+
+# Поля, которые реально отправляются в Bitrix (CSV_HEADERS): (метка в хеше, значение из финальной модели)
+_HASH_FIELDS = (
+    ("ФИО", lambda f: f.get("ФИО")),
+    ("Фамилия", lambda f: f.get("Фамилия")),
+    ("Имя", lambda f: f.get("Имя")),
+    ("Отчество", lambda f: f.get("Отчество")),
+    ("Возраст пациента", lambda f: f.get("Возраст пациента")),
+    ("ФИО консультанта", lambda f: f.get("ФИО консультанта")),
+    ("Тип пациента 1", lambda f: f.get("Статус пациента")),
+    ("Тип пациента 2", lambda f: f.get("Тип пациента")),
+    ("Доктор первичного приёма", lambda f: f.get("Доктор первичного приёма")),
+    ("Дата первичного приёма", lambda f: f.get("Дата первичного приёма")),
+    ("Количество визитов", lambda f: f.get("Количество визитов в клинику")),
+    ("Следующий визит", lambda f: f.get("Предстоящие приёмы")),
+    ("Стоимость предварительных планов", lambda f: f.get("Стоимость комплексных планов", 0)),
+    ("Стоимость согласованных планов", lambda f: f.get("Стоимость согласованных планов", 0)),
+    ("Сумма оплат", lambda f: f.get("Общая оплаченная сумма по согласованным планам")),
+    ("Процент выполнения", lambda f: f.get("Процент выполнения плана, %")),
+    ("Стадия", lambda f: f.get("Стадия")),
+    ("Текущая стадия лечения", lambda f: f.get("Текущая стадия лечения")),
+    ("Ответственный", lambda f: f.get("Ответственный")),
+    ("Филиал", lambda f: f.get("Филиал")),
+    ("По рекомендации", lambda f: f.get("По рекомендации")),
+)
+# Упаковщики собраны заранее: struct.pack разбирал бы строку формата на каждом значении
+_PACK_LEN = struct.Struct("<I").pack
+_PACK_DOUBLE = struct.Struct("<d").pack
+
+# Метки заранее закодированы и отсортированы — порядок полей входит в хеш
+_HASH_KEYS = tuple(
+    (_PACK_LEN(len(name.encode("utf-8"))) + name.encode("utf-8"), getter)
+    for name, getter in sorted(_HASH_FIELDS, key=lambda item: item[0])
+)
+
+
+def _hash_update(h, value) -> None:
+    # Компактная кодировка значения: 1 байт типа + данные (строки и контейнеры — с длиной)
+    if value is None:
+        h.update(b"\x00")
+    elif isinstance(value, str):
+        data = value.encode("utf-8")
+        h.update(b"\x01" + _PACK_LEN(len(data)))
+        h.update(data)
+    elif isinstance(value, bool):
+        h.update(b"\x03" if value else b"\x04")
+    elif isinstance(value, (int, float)):
+        h.update(b"\x02" + _PACK_DOUBLE(float(value)))
+    elif isinstance(value, (list, tuple)):
+        h.update(b"\x05" + _PACK_LEN(len(value)))
+        for item in value:
+            _hash_update(h, item)
+    elif isinstance(value, dict):
+        h.update(b"\x06" + _PACK_LEN(len(value)))
+        for key in sorted(value, key=str):
+            _hash_update(h, str(key))
+            _hash_update(h, value[key])
+    else:
+        h.update(b"\x07")
+        _hash_update(h, str(value))
+
+
+def _format_for(patient_data: dict, pcode: str | None = None) -> dict:
+    # format_patient_data один раз на собранные данные: хеш и рендер отчёта берут один результат
+    if pcode is None:
+        return format_patient_data(patient_data)
+    cached = _format_cache.get(pcode)
+    if cached is not None and cached[0] is patient_data:
+        return cached[1]
+    formatted = format_patient_data(patient_data)
+    _format_cache[pcode] = (patient_data, formatted)
+    return formatted
+
 
+# Хеш изменений не криптографический: берём самый быстрый из доступных.
+# Записи без hash_algo посчитаны прежними версиями — сверяемся их алгоритмом, а не перегенерируем отчёты
+_HASHERS = {"blake2b": lambda: hashlib.blake2b(digest_size=16)}
+if xxhash is not None:
+    _HASHERS["xxh3_64"] = xxhash.xxh3_64
+HASH_ALGO = "xxh3_64" if xxhash is not None else "blake2b"
+# Без hash_algo: исходная версия (MD5 от JSON) или потоковый blake2b — длина хеша у обоих одинаковая
+_LEGACY_HASH_ALGOS = ("md5", "blake2b")
 
-def calculate_patient_hash(patient_data: dict) -> str:
+
+def calculate_patient_hash(patient_data: dict, *, pcode: str | None = None, algo: str = HASH_ALGO) -> str:
     #Хешируем только те поля, которые уходят в Bitrix (CSV_HEADERS)
 
     # Берём финальную модель данных (как для CSV)
-    formatted = format_patient_data(dict(patient_data))
-
-    # Поля, которые реально отправляются в Bitrix
-    key_fields = {
-        "ФИО": formatted.get("ФИО"),
-        "Фамилия": formatted.get("Фамилия"),
-        "Имя": formatted.get("Имя"),
-        "Отчество": formatted.get("Отчество"),
-        "Возраст пациента": formatted.get("Возраст пациента"),
-        "ФИО консультанта": formatted.get("ФИО консультанта"),
-        "Тип пациента 1": formatted.get("Статус пациента"),
-        "Тип пациента 2": formatted.get("Тип пациента"),
-        "Доктор первичного приёма": formatted.get("Доктор первичного приёма"),
-        "Дата первичного приёма": formatted.get("Дата первичного приёма"),
-        "Количество визитов": formatted.get("Количество визитов в клинику"),
-        "Следующий визит": formatted.get("Предстоящие приёмы"),
-        "Стоимость предварительных планов": sum(p["Итого"] for p in formatted.get("Комплексные планы", [])),
-        "Стоимость согласованных планов": sum(p["Итого"] for p in formatted.get("Согласованные планы", [])),
-        "Сумма оплат": formatted.get("Общая оплаченная сумма по согласованным планам"),
-        "Процент выполнения": formatted.get("Процент выполнения плана, %"),
-        "Стадия": formatted.get("Стадия"),
-        "Текущая стадия лечения": formatted.get("Текущая стадия лечения"),
-        "Ответственный": formatted.get("Ответственный"),
-        "Филиал": formatted.get("Филиал"),
-        "По рекомендации": formatted.get("По рекомендации"),
-    }
+    formatted = _format_for(patient_data, pcode)
+    if algo == "md5":
+        return _legacy_md5_hash(formatted)
+
+    # Хешируем поля напрямую, без промежуточной JSON-строки
+    h = _HASHERS[algo]()
+    for tag, getter in _HASH_KEYS:
+        h.update(tag)
+        _hash_update(h, getter(formatted))
+    return h.hexdigest()
+
 
+def _legacy_md5_hash(formatted: dict) -> str:
+    # Хеш исходной версии: MD5 от JSON тех же ключевых полей — только для миграции старых записей
+    key_fields = {name: getter(formatted) for name, getter in _HASH_FIELDS}
     data_str = json.dumps(key_fields, sort_keys=True, ensure_ascii=False)
     return hashlib.md5(data_str.encode("utf-8")).hexdigest()
 
 
-
-def load_known_patients() -> dict:
-    if DATA_FILE.exists():
+def _saved_hash(entry: dict, patient_data: dict, pcode: str, current_hash: str) -> str | None:
+    # Сохранённый хеш для сравнения с current_hash. Посчитанный другим алгоритмом сверяем тем алгоритмом:
+    # совпал — данные не менялись, и запись переходит на текущий алгоритм без перегенерации отчёта
+    saved = entry.get("data_hash")
+    algo = entry.get("hash_algo")
+    if saved is None or algo == HASH_ALGO:
+        return saved
+    for legacy_algo in (algo,) if algo else _LEGACY_HASH_ALGOS:
+        if legacy_algo != "md5" and legacy_algo not in _HASHERS:
+            continue
         try:
-            text = DATA_FILE.read_text(encoding="utf-8").strip()
-            return json.loads(text) if text else {}
-        except json.JSONDecodeError:
-            stage_log("Хранилище пациентов", status="повреждено", файл=str(DATA_FILE))
-            return {}
-    return {}
+            legacy_hash = calculate_patient_hash(patient_data, pcode=pcode, algo=legacy_algo)
+        except (TypeError, ValueError):
+            # исходная версия падала на несериализуемых значениях — такой хеш не воспроизвести
+            continue
+        if legacy_hash == saved:
+            return current_hash
+    return saved
+
+
+def _report_content_key(formatted: dict, layout_version: int) -> str:
+    # data_hash покрывает только поля Bitrix; для кэша PDF хешируем всё, что попадает в отчёт, и версию вёрстки
+    h = hashlib.blake2b(digest_size=16)
+    _hash_update(h, layout_version)
+    _hash_update(h, formatted)
+    return h.hexdigest()
+
+
+def calculate_freshness_token(conn, pcode: str) -> list | None:
+    # Дешёвый однострочный «отпечаток» данных пациента; None — пациента нет в базе
+    row = fetch_freshness_token(conn, pcode)
+    if row is None:
+        return None
+    return [FRESHNESS_TOKEN_VERSION, *(_serialize_value(v) for v in row.values())]
 
 
-def save_known_patients(data: dict) -> None:
-    DATA_FILE.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+def _is_fresh(entry: dict, token: list | None) -> bool:
+    # Токен совпал и полная сверка была недавно — collect_patient_data можно не вызывать.
+    # Сохранённый токен другой версии не доверяем, даже если он случайно совпал
+    saved = entry.get("freshness_token")
+    if token is None or not entry.get("data_hash") or not saved or saved[0] != FRESHNESS_TOKEN_VERSION:
+        return False
+    if saved != token:
+        return False
+    checked = _parse_known_date(entry.get("freshness_checked"))
+    return checked is not None and date.today() - checked < FRESHNESS_TOKEN_TTL
 
 
-def process_patient(conn, pcode: str, known: dict, target_date: date, is_new: bool = False) -> None:
+def load_known_patients() -> dict:
+    # Файл пишется только атомарно (tmp + os.replace): ошибка разбора здесь — повод остановиться,
+    # а не начинать с пустого хранилища
+    global _loaded_digest
+    known = {}
+    if DATA_FILE.exists():
+        raw = DATA_FILE.read_bytes()
+        _loaded_digest = hashlib.blake2b(raw, digest_size=16).digest()
+        raw = raw.strip()
+        known = _json_loads(raw) if raw else {}
+    _replay_journal(known)
+    _migrate_last_checked(known)
+    return known
+
+
+def _migrate_last_checked(known: dict) -> None:
+    # last_checked раньше хранился строкой YYYY-MM-DD; теперь — ordinal даты, чтобы сравнивать целыми
+    for entry in known.values():
+        value = entry.get("last_checked")
+        if isinstance(value, str):
+            parsed = _parse_known_date(value)
+            entry["last_checked"] = parsed.toordinal() if parsed else None
+
+
+def _replay_journal(known: dict) -> None:
+    # Накатываем изменения, не успевшие попасть в known_patients.json (прерванный запуск)
+    if not JOURNAL_FILE.exists():
+        return
+    with JOURNAL_FILE.open("rb") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                known.update(_json_loads(line))
+            except ValueError:
+                # оборванная последняя запись — всё, что до неё, уже применено
+                stage_log("Журнал пациентов", status="повреждено", файл=str(JOURNAL_FILE))
+                break
+
+
+def append_known_journal(known: dict) -> None:
+    # Дописываем в журнал только изменённые записи: O(изменений), а не O(всех пациентов)
+    if not _dirty:
+        return
+    with JOURNAL_FILE.open("ab") as f:
+        for pcode in _dirty:
+            if pcode in known:
+                f.write(_json_dumps({pcode: known[pcode]}) + b"\n")
+        f.flush()
+        os.fsync(f.fileno())
+    _dirty.clear()
+
+
+def _iter_known_chunks(data: dict):
+    # Содержимое known_patients.json по записям — без одной гигантской строки в памяти
+    yield b"{"
+    for i, pcode in enumerate(sorted(data)):
+        yield b",\n" if i else b"\n"
+        yield _json_dumps(str(pcode)) + b": " + _json_dumps(data[pcode], sort_keys=True, indent=_KNOWN_JSON_INDENT)
+    yield b"\n}"
+
+
+def save_known_patients(data: dict) -> bool:
+    # Возвращает False, если содержимое совпало с загруженным и файл не переписывался.
+    # Сериализуем один раз: пишем во временный файл и тут же считаем дайджест; fsync и подмена — только при изменениях
+    global _loaded_digest
+    h = hashlib.blake2b(digest_size=16)
+    # Временный файл, fsync и атомарная подмена: при падении посреди записи остаётся прежний файл
+    tmp_path = DATA_FILE.with_suffix(".json.tmp")
+    try:
+        with tmp_path.open("wb", buffering=1 << 20) as f:
+            for chunk in _iter_known_chunks(data):
+                h.update(chunk)
+                f.write(chunk)
+            digest = h.digest()
+            changed = digest != _loaded_digest
+            if changed:
+                f.flush()
+                os.fsync(f.fileno())
+        if changed:
+            os.replace(tmp_path, DATA_FILE)
+        else:
+            tmp_path.unlink()
+    except Exception:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    if changed:
+        _fsync_dir(DATA_FILE.resolve().parent)
+        _loaded_digest = digest
+
+    # Основной файл совпадает с known — журнал больше не нужен
+    JOURNAL_FILE.unlink(missing_ok=True)
+    _dirty.clear()
+    return changed
+
+
+def pretty_dump_known(data: dict) -> str:
+    # Человекочитаемый вид known для отладки (основной файл пишется без отступов)
+    return _json_dumps(data, sort_keys=True, indent=True).decode("utf-8")
+
+
+def _fsync_dir(path: Path) -> None:
+    # Один fsync каталога фиксирует все os.replace в нём; на Windows O_DIRECTORY нет — пропускаем
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(path, os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _flush_reports(writer: BatchWriter, written: dict[Path, str], known: dict, existing_pdfs: set[str]) -> None:
+    # Дожидаемся фоновой записи; для незаписанных отчётов сбрасываем хеш, чтобы перегенерировать их
+    for path in writer.flush_and_wait():
+        pcode = written.get(path)
+        if pcode in known:
+            known[pcode]["data_hash"] = None
+            _dirty.add(pcode)
+        existing_pdfs.discard(path.name)
+    if written:
+        _fsync_dir(PDF_DIR)
+        written.clear()
+
+
+def _restore_from_cache(cache_pdf: Path, pdf_path: Path) -> bool:
+    # Такой же отчёт уже рендерили — ссылаемся на готовый файл вместо рендера
+    if not cache_pdf.exists():
+        return False
     try:
-        current_data = collect_patient_data(conn, pcode)
-        current_hash = calculate_patient_hash(current_data)
-        appts = fetch_future_appointments(conn, pcode)
-        
-        def _parse(s):
+        link_or_copy(cache_pdf, pdf_path)
+        os.utime(cache_pdf)  # живой элемент кэша не должен уйти под очистку
+    except OSError as e:
+        log.warning(f"Не удалось взять отчёт из кэша {cache_pdf}: {e}")
+        return False
+    return True
+
+
+def _prune_report_cache() -> None:
+    # Удаляем элементы кэша, на которые не ссылается ни один отчёт пациента и которые давно не использовались
+    cutoff = (datetime.now() - REPORT_CACHE_TTL).timestamp()
+    removed = 0
+    with os.scandir(REPORT_CACHE_DIR) as it:
+        for e in it:
             try:
-                return datetime.strptime(s, "%Y-%m-%d").date()
-            except:
-                return None
+                st = e.stat()
+                if e.is_file() and st.st_nlink <= 1 and st.st_mtime < cutoff:
+                    os.unlink(e.path)
+                    removed += 1
+            except OSError as err:
+                log.warning(f"Не удалось очистить {e.path}: {err}")
+    if removed:
+        log.info(f"Кэш отчётов: удалено устаревших файлов: {removed}")
+
+
+def _scan_existing_pdfs() -> set[str]:
+    # Один проход по каталогу вместо stat() на каждого пациента
+    with os.scandir(PDF_DIR) as it:
+        return {e.name for e in it if e.is_file()}
+
+
+def process_patient(
+    conn, pcode: str, known: dict, target_date: date, is_new: bool = False,
+    existing_pdfs: set[str] | None = None, writer: BatchWriter | None = None,
+    *, current_data: dict | None = None, current_hash: str | None = None,
+    freshness_token: list | None = None,
+) -> Path | None:
+    # Возвращает путь к перегенерированному PDF (или None, если отчёт не менялся).
+    # current_data/current_hash/freshness_token — уже собранное вызывающим, чтобы не ходить в БД повторно
+    with _known_lock:
+        _dirty.add(pcode)  # любая ветка ниже меняет known[pcode]
+    try:
+        pdf_path = PDF_DIR / f"patient_{pcode}.pdf"
 
-        dates = [_parse(a.get("WORK_DATE_STR")) for a in appts]
-        latest_appt = max([d for d in dates if d], default=None)
-        if latest_appt:
-            latest_appt = latest_appt.strftime("%Y-%m-%d")
+        pdf_exists = pdf_path.name in existing_pdfs if existing_pdfs is not None else pdf_path.exists()
+
+        if current_data is None:
+            # Токен снимаем до сбора данных: изменения после него дадут несовпадение в следующий раз
+            freshness_token = calculate_freshness_token(conn, pcode)
+            with _known_lock:
+                entry = known.get(pcode, {})
+                # при пустой дате приёма правило ниже всё равно требует перегенерации — его не обходим
+                unchanged = (
+                    pdf_exists
+                    and entry.get("last_appointment_date") is not None
+                    and _is_fresh(entry, freshness_token)
+                )
+                if unchanged:
+                    entry["last_checked"] = target_date.toordinal()
+                    entry["processed_on"] = str(target_date)
+            if unchanged:
+                # Токен (он покрывает все поля хеша, см. SQL_GET_FRESHNESS_TOKEN) совпал и отчёт на месте —
+                # collect_patient_data не нужен
+                if is_new:
+                    patient_log(pcode, status="внесен", comment="новый пациент")
+                else:
+                    patient_log(pcode, status="пропущен", comment="без изменений")
+                return None
+            current_data = collect_patient_data(conn, pcode)
+        if current_hash is None:
+            current_hash = calculate_patient_hash(current_data, pcode=pcode)
+        # будущие приёмы уже есть в собранных данных — отдельный запрос не нужен
+        appts = current_data.get("future_appointments") or []
 
-        patient_info = known.get(pcode, {})
-        last_saved_appt = patient_info.get("last_appointment_date")
-        last_saved_hash = patient_info.get("data_hash")
+        # Запросы приёмов сортируют по SCHEDULE_WORKDATE по возрастанию (так их и показывает отчёт),
+        # поэтому самый поздний приём — последний; WORK_DATE_STR — ISO-строка YYYY-MM-DD
+        latest_appt = (appts[-1].get("WORK_DATE_STR") or None) if appts else None
 
-        pdf_path = PDF_DIR / f"patient_{pcode}.pdf"
+        with _known_lock:
+            patient_info = known.get(pcode, {})
+            last_saved_appt = patient_info.get("last_appointment_date")
+            last_saved_hash = _saved_hash(patient_info, current_data, pcode, current_hash)
 
         need_regen = False
-        if not pdf_path.exists():
+        if not pdf_exists:
             need_regen = True
         elif current_hash != last_saved_hash:
             need_regen = True
@@ -132,44 +517,169 @@ def process_patient(conn, pcode: str, known: dict, target_date: date, is_new: bo
             need_regen = True
 
         if need_regen:
-            build_patient_report(conn, pcode, str(pdf_path))
-            known[pcode] = {
-                "last_appointment_date": latest_appt,
-                "data_hash": current_hash,
-                "last_checked": str(target_date),
-                "last_updated": str(date.today()),
-                "processed_on": str(target_date),
-            }
+            # reportlab подтягиваем только когда отчёт действительно нужен
+            from app.reports.patient_report import REPORT_LAYOUT_VERSION, build_patient_report_bytes
+            formatted = _format_for(current_data, pcode)
+            cache_pdf = REPORT_CACHE_DIR / f"{_report_content_key(formatted, REPORT_LAYOUT_VERSION)}.pdf"
+            if not _restore_from_cache(cache_pdf, pdf_path):
+                # Запись атомарная (tmp + os.replace): оборванный PDF не окажется под «актуальным» хешем
+                if writer is not None:
+                    # В пул процессов уходит только готовый formatted; ошибка рендера всплывёт при сбросе писателя
+                    writer.submit_render(
+                        pdf_path, build_patient_report_bytes, pcode, formatted=formatted, cache_path=cache_pdf
+                    )
+                else:
+                    write_atomic(pdf_path, build_patient_report_bytes(pcode, formatted=formatted))
+                    try:
+                        link_or_copy(pdf_path, cache_pdf)
+                    except OSError as e:
+                        log.warning(f"Не удалось положить отчёт в кэш {cache_pdf}: {e}")
+            if existing_pdfs is not None:
+                existing_pdfs.add(pdf_path.name)
+            with _known_lock:
+                known[pcode] = {
+                    "last_appointment_date": latest_appt,
+                    "data_hash": current_hash,
+                    "hash_algo": HASH_ALGO,
+                    "last_checked": target_date.toordinal(),
+                    "last_updated": str(date.today()),
+                    "processed_on": str(target_date),
+                    "freshness_token": freshness_token,
+                    "freshness_checked": str(date.today()),
+                }
             if is_new:
                 patient_log(pcode, status="внесен", comment="новый пациент")
             else:
                 patient_log(pcode, status="обновлен", comment="генерация отчёта", pdf=pdf_path.name)
+            return pdf_path
         else:
-            known.setdefault(pcode, {})
-            known[pcode]["last_checked"] = str(target_date)
-            known[pcode]["processed_on"] = str(target_date)
+            with _known_lock:
+                entry = known.setdefault(pcode, {})
+                # хеш совпал (возможно, посчитанный прежним алгоритмом) — храним его в текущем
+                entry["data_hash"] = current_hash
+                entry["hash_algo"] = HASH_ALGO
+                entry["last_checked"] = target_date.toordinal()
+                entry["processed_on"] = str(target_date)
+                entry["freshness_token"] = freshness_token
+                entry["freshness_checked"] = str(date.today())
             if is_new:
                 patient_log(pcode, status="внесен", comment="новый пациент")
             else:
                 patient_log(pcode, status="пропущен", comment="без изменений")
 
     except Exception as e:
-        known.setdefault(pcode, {})
-        known[pcode]["processed_on"] = str(target_date)
+        with _known_lock:
+            known.setdefault(pcode, {})["processed_on"] = str(target_date)
         patient_log(pcode, status="ошибка", comment="не удалось обработать", ошибка=str(e))
+    finally:
+        _format_cache.pop(pcode, None)
+    return None
+
 
+def _pooled_freshness_token(pool, pcode: str):
+    # Выполняется в потоке; ошибку возвращаем, а не пробрасываем — иначе map оборвётся на ней
+    try:
+        with pooled_connection(pool) as conn:
+            return calculate_freshness_token(conn, pcode), None
+    except Exception as e:
+        return None, e
+
+
+def _recheck_known_pcode(
+    pool, pcode: str, token: list | None, current_data: dict | None, known: dict, target_date: date,
+    existing_pdfs: set[str], writer: BatchWriter,
+) -> tuple[bool, Path | None]:
+    # Выполняется в потоке: сверка хеша известного пациента; возвращает (хеш изменился, записанный PDF)
+    try:
+        with pooled_connection(pool) as conn:
+            if current_data is None:
+                current_data = collect_patient_data(conn, pcode)
+            current_hash = calculate_patient_hash(current_data, pcode=pcode)
+            with _known_lock:
+                last_saved_hash = _saved_hash(known[pcode], current_data, pcode, current_hash)
+
+            changed = last_saved_hash != current_hash
+            written = None
+            if changed:
+                # Хеш изменился → пересоздаем отчёт
+                log.info(f"Изменения у {pcode}: хэш изменился — пересоздаём отчёт")
+                written = process_patient(
+                    conn, pcode, known, target_date, is_new=False, existing_pdfs=existing_pdfs, writer=writer,
+                    current_data=current_data, current_hash=current_hash, freshness_token=token,
+                )
+
+        with _known_lock:
+            entry = known[pcode]
+            if changed:
+                # обновляем только нужные поля
+                entry["last_updated"] = str(date.today())
+            # при неизменных данных хеш тот же, но мог быть посчитан прежним алгоритмом
+            entry["data_hash"] = current_hash
+            entry["hash_algo"] = HASH_ALGO
+            # при неизменном хеше — только дата проверки
+            entry["last_checked"] = target_date.toordinal()
+            # Запоминаем токен, снятый до сбора данных: изменения после него дадут несовпадение
+            entry["freshness_token"] = token
+            entry["freshness_checked"] = str(date.today())
+            _dirty.add(pcode)
+        return changed, written
 
-def process_and_register_patient(conn, pcode, known, target_date, all_processed_pcodes, is_new=False):
-    process_patient(conn, pcode, known, target_date, is_new)
-    if pcode not in all_processed_pcodes:
-        all_processed_pcodes.append(pcode)
+    except Exception as e:
+        log.error(f"Ошибка при проверке {pcode}: {e}")
+        return False, None
+    finally:
+        _format_cache.pop(pcode, None)
+
+
+def _process_pcode_task(
+    pool, pcode: str, info: dict, known: dict, target_date: date, source: str, is_new: bool,
+    existing_pdfs: set[str], writer: BatchWriter,
+) -> Path | None:
+    # Выполняется в потоке: своё соединение из пула на время задачи
+    with pooled_connection(pool) as conn:
+        with _known_lock:
+            if pcode not in known:
+                known[pcode] = {
+                    "last_checked": target_date.toordinal(),
+                    "last_appointment_date": None,
+                    "data_hash": None,
+                }
+                log.info(f"Новый пациент ({source}): {pcode} {info.get('LASTNAME','')} {info.get('FIRSTNAME','')}")
+        return process_patient(
+            conn, pcode, known, target_date, is_new=is_new, existing_pdfs=existing_pdfs, writer=writer
+        )
+
+
+def _due_index(entry: dict | None, range_ordinals: List[int]) -> int:
+    # Индекс первой даты диапазона, начиная с которой пациент снова подлежит обработке (last_checked < target_date).
+    # last_checked — ordinal даты: сравнение целых без разбора строк
+    last_checked = (entry or {}).get("last_checked")
+    if last_checked is None:
+        return 0
+    return bisect_right(range_ordinals, last_checked)
+
+
+def init_app() -> None:
+    # Настройки, логирование и каталоги — один раз, из точки входа основного процесса
+    global settings
+    load_non_secret_env(str(ENV_PATH))
+    settings = Settings()
+    setup_logging(
+        level=getattr(settings, "LOG_LEVEL", "INFO"),
+        log_file=getattr(settings, "LOG_FILE", "logs/app.log"),
+        audit_log_file=getattr(settings, "AUDIT_LOG_FILE", "logs/audit.log"),
+    )
+    PDF_DIR.mkdir(parents=True, exist_ok=True)
+    REPORT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
 
 
 def main(date_range: List[date], filter_pcodes: List[str] | None = None) -> None:
     log.info(f"Запуск обработки за диапазон {date_range[0]} → {date_range[-1]}")
     known = load_known_patients()
 
-    all_processed_pcodes: list[str] = []
+    # Порядок не важен (экспорт всё равно сортирует), нужна только уникальность — множество
+    all_processed_pcodes: set[str] = set()
+    written_reports: dict[Path, str] = {}
 
     csv_dir = Path("output") / "csv"
     csv_dir.mkdir(parents=True, exist_ok=True)
@@ -186,110 +696,159 @@ def main(date_range: List[date], filter_pcodes: List[str] | None = None) -> None
         except Exception as e:
             log.warning(f"Не удалось удалить {p}: {e}")
 
-    with get_connection(settings) as conn:
+    # " 0123" и "123" — один пациент: ключи пакетных выборок приходят из БД уже без пробелов и нулей
+    filter_pcodes = list(dict.fromkeys(normalize_pcode(p) for p in filter_pcodes or []))
+    workers = settings.WORKERS
+
+    # Драйвер БД подтягиваем только для настоящего запуска: --help и ошибки аргументов обходятся без него
+    from app.db.client import get_connection
+
+    with get_connection(settings) as conn, ExitStack() as stack:
+        render_pool = None
+        if settings.RENDER_WORKERS > 1:
+            # Пул входит в стек раньше писателя, поэтому закрывается после того, как писатель дождался рендеров.
+            # spawn явно и на всех ОС: fork копировал бы процесс с потоками, захваченными блокировками
+            # и сокетами соединений с БД
+            render_pool = stack.enter_context(ProcessPoolExecutor(
+                max_workers=settings.RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn"),
+            ))
+        writer = stack.enter_context(
+            BatchWriter(threads=settings.REPORT_WRITER_THREADS, render_pool=render_pool)
+        )
+        if workers > 1:
+            # Пациентов обрабатываем параллельно: у каждого потока своё соединение из пула
+            pool = stack.enter_context(connection_pool(settings, workers))
+            run_map = stack.enter_context(ThreadPoolExecutor(max_workers=workers)).map
+        else:
+            # WORKERS <= 1 — последовательно, на основном соединении и без пула потоков
+            pool = shared_connection_pool(conn)
+            run_map = map
+
         log.info("Обновляем известных пациентов перед обработкой дат...")
         # Получаем всех пациентов типа "Повторный пациент под кураторством"
         repeat_rows = fetch_repeat_patients(conn)
-        repeat_pcodes = {str(r["PCODE"]) for r in repeat_rows}
+        # Список строится один раз за запуск и переиспользуется на каждой дате
+        repeat_pcodes = list(dict.fromkeys(str(r["PCODE"]) for r in repeat_rows))
         log.info(f"Повторных пациентов под кураторством: {len(repeat_pcodes)}")
 
-        # Проверяем ВСЕХ пациентов из known_patients.json
-        for pcode, pdata in list(known.items()):
-            try:
-                current_data = collect_patient_data(conn, pcode)
-                current_hash = calculate_patient_hash(current_data)
-                last_saved_hash = pdata.get("data_hash")
-
-                if last_saved_hash != current_hash:
-                    # Хеш изменился → пересоздаем отчёт
-                    log.info(f"Изменения у {pcode}: хэш изменился — пересоздаём отчёт")
-
-                    process_patient(conn, pcode, known, date_range[0], is_new=False)
+        existing_pdfs = _scan_existing_pdfs()
 
-                    # обновляем только нужные поля
-                    known[pcode]["data_hash"] = current_hash
-                    known[pcode]["last_checked"] = str(date_range[0])
-                    known[pcode]["last_updated"] = str(date.today())
-
-                    # включаем в CSV
-                    if pcode not in all_processed_pcodes:
-                        all_processed_pcodes.append(pcode)
+        # Проверяем ВСЕХ пациентов из known_patients.json.
+        # Проход 1: токены свежести — свежих пропускаем, остальных собираем для пакетной выгрузки
+        known_pcodes = list(known)
+        stale_tokens = {}
+        token_results = run_map(lambda pc: _pooled_freshness_token(pool, pc), known_pcodes)
+        for pcode, (token, error) in zip(known_pcodes, token_results):
+            if error is not None:
+                log.error(f"Ошибка при проверке {pcode}: {error}")
+                continue
+            if _is_fresh(known[pcode], token):
+                known[pcode]["last_checked"] = date_range[0].toordinal()
+                _dirty.add(pcode)
+                continue
+            stale_tokens[pcode] = token
 
+        # Проход 2: данные несвежих пациентов одной пачкой IN-запросов вместо запросов на каждого
+        try:
+            bulk = collect_patient_data_bulk(conn, list(stale_tokens))
+        except Exception as e:
+            log.error(f"Пакетная выгрузка данных не удалась, собираем по одному: {e}")
+            bulk = {}
+
+        recheck_results = run_map(
+            lambda item: _recheck_known_pcode(
+                pool, item[0], item[1], bulk.get(item[0]), known, date_range[0], existing_pdfs, writer
+            ),
+            stale_tokens.items(),
+        )
+        for pcode, (changed, written) in zip(stale_tokens, recheck_results):
+            if written:
+                written_reports[written] = pcode
+            # включаем в CSV
+            if changed:
+                all_processed_pcodes.add(pcode)
+
+        _flush_reports(writer, written_reports, known, existing_pdfs)
+        append_known_journal(known)
+
+        # Очередь дат считаем один раз за запуск, а не для каждой даты диапазона
+        range_ordinals = [d.toordinal() for d in date_range]
+        due_by_pcode = {pcode: _due_index(entry, range_ordinals) for pcode, entry in known.items()}
+
+        def _run_batch(pcodes, target_date: date, source: str, is_new: bool, infos: dict, processed: set[str]) -> None:
+            # infos — основная информация, выбранная заранее пакетно: кого в ней нет, того нет в базе.
+            # processed — уже обработанные за эту дату другими ветками: второй раз данные не собираем
+            found = []
+            for pcode in pcodes:
+                if pcode in processed:
+                    continue
+                if pcode in infos:
+                    found.append(pcode)
                 else:
-                    # Хеш НЕ изменился — только обновляем дату проверки
-                    known[pcode]["last_checked"] = str(date_range[0])
-
-            except Exception as e:
-                log.error(f"Ошибка при проверке {pcode}: {e}")
-                continue
+                    log.warning(f"Пациент с PCODE={pcode} не найден в базе")
+            results = run_map(
+                lambda pc: _process_pcode_task(
+                    pool, pc, infos[pc], known, target_date, source, is_new, existing_pdfs, writer
+                ),
+                found,
+            )
+            processed.update(found)
+            # Результаты сводим в одном потоке
+            for pcode, written in zip(found, results):
+                all_processed_pcodes.add(pcode)
+                if written:
+                    written_reports[written] = pcode
+                # last_checked мог сдвинуться — переносим пациента на следующую подходящую дату
+                due_by_pcode[pcode] = _due_index(known.get(pcode), range_ordinals)
+
+        # Основная информация повторных и заданных вручную пациентов одинакова для всех дат — берём её один раз
+        main_info_cache = fetch_main_info_bulk(conn, repeat_pcodes + filter_pcodes)
+
+        # Первичные приёмы за весь диапазон — одним запросом до цикла, а не по запросу на каждую дату
+        primary_by_date = {}
+        if not filter_pcodes:
+            primary_by_date = fetch_primary_patients_range(conn, date_range[0], date_range[-1])
 
-        for target_date in date_range:
+        for day_idx, target_date in enumerate(date_range):
             log.info(f"\n=== Обработка за {target_date} ===")
-            processed_today: list[str] = []
-
-            # СНАЧАЛА: повторные пациенты под кураторством
-            for pcode in repeat_pcodes:
-                info = fetch_main_info(conn, pcode)
-                if not info:
-                    log.warning(f"Пациент с PCODE={pcode} не найден")
-                    continue
+            existing_pdfs = _scan_existing_pdfs()
+            # PCODE, обработанные за эту дату: пациент из нескольких веток обрабатывается один раз
+            processed_set: set[str] = set()
 
-                if pcode not in known:
-                    known[pcode] = {
-                        "last_checked": str(target_date),
-                        "last_appointment_date": None,
-                        "data_hash": None,
-                    }
-                    log.info(
-                        f"Новый пациент (повторный под кураторством): {pcode} {info.get('LASTNAME', '')} {info.get('FIRSTNAME', '')}")
-
-                process_and_register_patient(
-                    conn, pcode, known, target_date,
-                    all_processed_pcodes, is_new=False  # Аналогично обновлению старых
-                )
-                processed_today.append(pcode)
+            # СНАЧАЛА: повторные пациенты под кураторством (аналогично обновлению старых)
+            _run_batch(
+                repeat_pcodes, target_date, "повторный под кураторством", is_new=False,
+                infos=main_info_cache, processed=processed_set,
+            )
 
             if filter_pcodes:
-                for pcode in filter_pcodes:
-                    info = fetch_main_info(conn, pcode)
-                    if not info:
-                        log.warning(f"Пациент с PCODE={pcode} не найден в базе")
-                        continue
-
-                    if pcode not in known:
-                        known[pcode] = {
-                            "last_checked": str(target_date),
-                            "last_appointment_date": None,
-                            "data_hash": None,
-                        }
-                        log.info(f"Новый пациент (по PCODE): {pcode} {info.get('LASTNAME','')} {info.get('FIRSTNAME','')}")
-                    process_and_register_patient(conn, pcode, known, target_date, all_processed_pcodes, is_new=True)
-                    processed_today.append(pcode)
+                _run_batch(
+                    filter_pcodes, target_date, "по PCODE", is_new=True,
+                    infos=main_info_cache, processed=processed_set,
+                )
 
             if not filter_pcodes:
-                new_patients = fetch_primary_patients_today(conn, target_date)
-                for p in new_patients:
+                due_infos = {}
+                for p in primary_by_date.get(target_date, []):
                     pcode = str(p["PCODE"])
-                    last_checked_str = known.get(pcode, {}).get("last_checked")
-                    try:
-                        last_checked = datetime.strptime(last_checked_str, "%Y-%m-%d").date() if last_checked_str else None
-                    except ValueError:
-                        last_checked = None
-
-                    if not last_checked or last_checked < target_date:
-                        if pcode not in known:
-                            known[pcode] = {
-                                "last_checked": str(target_date),
-                                "last_appointment_date": None,
-                                "data_hash": None,
-                            }
-                            log.info(f"Новый пациент (по дате): {pcode} {p.get('LASTNAME','')} {p.get('FIRSTNAME','')}")
-                        process_and_register_patient(conn, pcode, known, target_date, all_processed_pcodes, is_new=True)
-                        processed_today.append(pcode)
+                    if due_by_pcode.get(pcode, 0) <= day_idx:
+                        due_infos.setdefault(pcode, p)
+                _run_batch(
+                    list(due_infos), target_date, "по дате", is_new=True,
+                    infos=due_infos, processed=processed_set,
+                )
+
+            # Контрольная точка на дату: сначала отчёты, затем журнал known — а не на каждый PDF
+            _flush_reports(writer, written_reports, known, existing_pdfs)
+            append_known_journal(known)
+
+        _prune_report_cache()
+        _format_cache.clear()
 
         if all_processed_pcodes:
-            unique_pcodes = sorted(set(all_processed_pcodes))
+            unique_pcodes = sorted(all_processed_pcodes)
             try:
+                from app.export.csv_exporter import export_patients_to_csv, export_personal_data_to_csv
                 export_patients_to_csv(conn, unique_pcodes, csv_path_med)
                 export_personal_data_to_csv(conn, unique_pcodes, csv_path_pers)
                 log.info(f"Экспорт CSV: всего {len(unique_pcodes)} пациентов")
@@ -298,8 +857,10 @@ def main(date_range: List[date], filter_pcodes: List[str] | None = None) -> None
         else:
             log.info("Нет пациентов для экспорта CSV")
 
-        save_known_patients(known)
-        log.info(f"Файл known_patients.json обновлён ({len(known)} записей)")
+        if save_known_patients(known):
+            log.info(f"Файл known_patients.json обновлён ({len(known)} записей)")
+        else:
+            log.info(f"Файл known_patients.json не изменился ({len(known)} записей)")
 
         if all_processed_pcodes:
             try:
@@ -318,7 +879,7 @@ def main(date_range: List[date], filter_pcodes: List[str] | None = None) -> None
         else:
             log.warning("Нет данных для загрузки в Битрикс")
 
-    log.info(f"Обработка диапазона завершена. Всего уникальных пациентов: {len(set(all_processed_pcodes))}")
+    log.info(f"Обработка диапазона завершена. Всего уникальных пациентов: {len(all_processed_pcodes)}")
 
 
 if __name__ == "__main__":
@@ -332,8 +893,8 @@ if __name__ == "__main__":
 
     if args.start_date and args.end_date:
         try:
-            start_date = datetime.strptime(args.start_date, "%d.%m.%Y").date()
-            end_date = datetime.strptime(args.end_date, "%d.%m.%Y").date()
+            start_date = _parse_ddmmyyyy(args.start_date)
+            end_date = _parse_ddmmyyyy(args.end_date)
         except ValueError:
             raise SystemExit("Ошибка: даты должны быть в формате dd.MM.yyyy")
         if start_date > end_date:
@@ -341,7 +902,7 @@ if __name__ == "__main__":
         date_range = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
     elif args.date:
         try:
-            single_date = datetime.strptime(args.date, "%d.%m.%Y").date()
+            single_date = _parse_ddmmyyyy(args.date)
             date_range = [single_date]
         except ValueError:
             raise SystemExit("Ошибка: укажи дату в формате dd.MM.yyyy")
@@ -355,5 +916,10 @@ if __name__ == "__main__":
         filter_pcodes = [p for p in pcode_list if p]
         if not filter_pcodes:
             raise SystemExit("Ошибка: указаны пустые PCODE")
+        try:
+            filter_pcodes = [normalize_pcode(p) for p in filter_pcodes]
+        except ValueError:
+            raise SystemExit(f"Ошибка: PCODE должен быть числом: {args.pcode}")
 
+    init_app()
     main(date_range, filter_pcodes)
@@ -0,0 +1,111 @@
+from __future__ import annotations
+import os
+import queue
+import shutil
+import threading
+from concurrent.futures import Executor, Future
+from pathlib import Path
+
+from app.custom_logging import get_logger
+
+log = get_logger(__name__)
+
+
+def write_atomic(path: Path, data: bytes) -> None:
+    # Пишем во временный файл и атомарно подменяем: оборванный файл не окажется под итоговым именем
+    tmp_path = path.with_name(path.name + ".tmp")
+    try:
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def link_or_copy(src: Path, dst: Path) -> None:
+    # Жёсткая ссылка (без копирования данных), где ФС не умеет — копия; подмена dst тоже атомарная
+    tmp_path = dst.with_name(dst.name + ".tmp")
+    tmp_path.unlink(missing_ok=True)
+    try:
+        try:
+            os.link(src, tmp_path)
+        except OSError:
+            shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except Exception:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+class BatchWriter:
+    # Фоновая запись готовых PDF: рендер следующего пациента не ждёт записи предыдущего.
+    # Несколько потоков держат в полёте несколько записей сразу.
+    # render_pool — пул процессов для рендера: reportlab держит GIL, в потоках рендеры шли бы по очереди
+
+    def __init__(self, threads: int = 1, render_pool: Executor | None = None) -> None:
+        self._render_pool = render_pool
+        self._queue: queue.Queue = queue.Queue()
+        self._failed: list[Path] = []
+        self._lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self._run, name=f"report-writer-{i}", daemon=True)
+            for i in range(max(1, threads))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit_render(self, path: Path, render, *args, cache_path: Path | None = None, **kwargs) -> None:
+        # render(*args, **kwargs) -> bytes. С пулом — рендер в другом процессе, результат ждёт поток записи;
+        # без пула — рендер сразу в вызывающем потоке. cache_path — после записи сослаться на файл из кэша отчётов
+        if self._render_pool is None:
+            data = render(*args, **kwargs)
+        else:
+            data = self._render_pool.submit(render, *args, **kwargs)
+        self._queue.put((Path(path), data, cache_path))
+
+    def flush_and_wait(self) -> list[Path]:
+        # Ждём, пока очередь опустеет; возвращаем пути, которые записать не удалось
+        self._queue.join()
+        with self._lock:
+            failed, self._failed = self._failed, []
+        return failed
+
+    def close(self) -> list[Path]:
+        failed = self.flush_and_wait()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        return failed
+
+    def __enter__(self) -> BatchWriter:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        for path in self.close():
+            log.error(f"Отчёт не записан: {path}")
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                path, data, cache_path = item
+                try:
+                    if isinstance(data, Future):
+                        data = data.result()
+                    write_atomic(path, data)
+                except Exception as e:
+                    log.error(f"Ошибка рендера или записи {path}: {e}")
+                    with self._lock:
+                        self._failed.append(path)
+                    continue
+                if cache_path is not None:
+                    try:
+                        link_or_copy(path, cache_path)
+                    except Exception as e:
+                        # кэш — только ускорение: отчёт пациента уже записан
+                        log.warning(f"Не удалось положить отчёт в кэш {cache_path}: {e}")
+            finally:
+                self._queue.task_done()
@@ -1,13 +1,18 @@
 from __future__ import annotations
 
-from datetime import datetime
+import copy
+import io
+from datetime import date, datetime
+from functools import lru_cache
 from pathlib import Path
 from typing import Any, Iterable, Mapping
 
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+from reportlab.lib.utils import simpleSplit
 from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.pdfmetrics import stringWidth
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.platypus import (
     KeepTogether,
@@ -20,15 +25,23 @@ from reportlab.platypus import (
 )
 
 from app.db.extract import collect_patient_data
+from app.reports.batch_writer import write_atomic
 from app.utils.formatting import format_patient_data
 
 
-def _register_preferred_font(font_name: str, candidates: Iterable[Path]) -> str:
+# Меняется при любой правке вёрстки отчёта: ключ кэша готовых PDF учитывает её
+REPORT_LAYOUT_VERSION = 3
+
+
+def _register_preferred_font(font_name: str, candidates: Iterable[Path], fallback: str = "Helvetica") -> str:
+    # Повторный вызов (модуль заново импортирован в процессе рендера) шрифт не перерегистрирует
+    if font_name in pdfmetrics.getRegisteredFontNames():
+        return font_name
     for candidate in candidates:
         if candidate.exists():
             pdfmetrics.registerFont(TTFont(font_name, str(candidate)))
             return font_name
-    return "Helvetica"
+    return fallback
 
 
 FONT_NAME = _register_preferred_font(
@@ -40,10 +53,149 @@ FONT_NAME = _register_preferred_font(
     ),
 )
 
+# Без жирного TTF остаёмся на обычном: Helvetica-Bold не умеет кириллицу
+FONT_NAME_BOLD = _register_preferred_font(
+    "Arial-Bold",
+    (
+        Path("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"),
+        Path("/System/Library/Fonts/Supplemental/Arial Bold.ttf"),
+        Path("C:/Windows/Fonts/arialbd.ttf"),
+    ),
+    fallback="Helvetica-Bold" if FONT_NAME == "Helvetica" else FONT_NAME,
+)
+
+
+# Стили не меняются от отчёта к отчёту — собираем один раз при импорте, а не на каждый PDF
+_STYLES = getSampleStyleSheet()
+_NORMAL = _STYLES["Normal"]
+_NORMAL.fontName = FONT_NAME
+_TITLE_STYLE = ParagraphStyle(
+    "Title",
+    parent=_STYLES["Heading1"],
+    alignment=1,
+    spaceAfter=10,
+    fontName=FONT_NAME,
+)
+_H2_STYLE = ParagraphStyle("H2", parent=_STYLES["Heading2"], fontName=FONT_NAME)
+
+_FUTURE_TABLE_STYLE = TableStyle([
+    ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
+    ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
+    ("FONTNAME", (0, 0), (-1, -1), FONT_NAME),
+    ("FONTSIZE", (0, 0), (-1, -1), 8),
+    ("VALIGN", (0, 0), (-1, -1), "TOP"),
+    ("ALIGN", (0, 0), (0, -1), "CENTER"),  # выравнивание даты
+    ("ALIGN", (-1, 1), (-1, -1), "CENTER"),  # выравнивание статуса
+    ("LEFTPADDING", (0, 0), (-1, -1), 3),
+    ("RIGHTPADDING", (0, 0), (-1, -1), 3),
+])
+
+_COMPLEX_TABLE_STYLE = TableStyle([
+    ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
+    ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
+    ("FONTNAME", (0, 0), (-1, -1), FONT_NAME),
+    ("FONTSIZE", (0, 0), (-1, -1), 9),
+    ("BACKGROUND", (0, -1), (-1, -1), colors.whitesmoke),
+    ("ALIGN", (1, 1), (-1, -1), "CENTER"),
+    ("ALIGN", (2, 1), (-1, -1), "RIGHT"),
+    ("VALIGN", (0, 0), (-1, -1), "TOP"),
+])
+
+_APPROVED_TABLE_STYLE = TableStyle([
+    ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
+    ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
+    ("BACKGROUND", (0, -1), (-1, -1), colors.lightgrey),
+    ("FONTNAME", (0, 0), (-1, -1), FONT_NAME),
+    ("FONTSIZE", (0, 0), (-1, -1), 8),
+    ("ALIGN", (1, 1), (-1, -1), "CENTER"),
+    ("VALIGN", (0, 0), (-1, -1), "TOP"),
+])
+
+
+# Основные сведения — таблица «подпись: значение» вместо отдельного Paragraph на каждое поле
+# Строки блоков основных сведений: (подпись, ключ в formatted, значение по умолчанию)
+_PERSONAL_INFO_FIELDS = (
+    ("ФИО:", "ФИО", "—"),
+    ("Дата рождения:", "Дата рождения", "—"),
+    ("Адрес:", "Адрес", "—"),
+    ("Телефон:", "Телефон", "—"),
+    ("Email:", "Email", "—"),
+)
+_CLINIC_INFO_FIELDS = (
+    ("ФИО консультанта:", "ФИО консультанта", "—"),
+    ("Дата первичного приёма:", "Дата первичного приёма", "—"),
+    ("Доктор первичного приёма:", "Доктор первичного приёма", "—"),
+    ("Статус пациента:", "Статус пациента", "—"),
+    ("Тип пациента:", "Тип пациента", "—"),
+    ("Текущая стадия лечения:", "Текущая стадия лечения", "—"),
+    ("Количество визитов в клинику:", "Количество визитов в клинику", 0),
+)
+
+_INFO_FONT_SIZE = 10
+_INFO_CELL_PADDING = 6
+_INFO_TABLE_WIDTH = 450
+# Колонка подписей — по самой длинной подписи жирным шрифтом плюс отступ до значения,
+# общая для обоих блоков, чтобы значения стояли в одну линию
+_INFO_LABEL_WIDTH = max(
+    stringWidth(label, FONT_NAME_BOLD, _INFO_FONT_SIZE)
+    for label, _, _ in _PERSONAL_INFO_FIELDS + _CLINIC_INFO_FIELDS
+) + _INFO_CELL_PADDING
+_INFO_VALUE_WIDTH = _INFO_TABLE_WIDTH - _INFO_LABEL_WIDTH
+_INFO_TABLE_STYLE = TableStyle([
+    ("FONTNAME", (0, 0), (0, -1), FONT_NAME_BOLD),
+    ("FONTNAME", (1, 0), (1, -1), FONT_NAME),
+    ("FONTSIZE", (0, 0), (-1, -1), _INFO_FONT_SIZE),
+    ("LEADING", (0, 0), (-1, -1), 12),
+    ("VALIGN", (0, 0), (-1, -1), "TOP"),
+    ("LEFTPADDING", (0, 0), (0, -1), 0),
+    ("RIGHTPADDING", (0, 0), (0, -1), _INFO_CELL_PADDING),
+    ("LEFTPADDING", (1, 0), (1, -1), _INFO_CELL_PADDING),
+    ("RIGHTPADDING", (1, 0), (1, -1), 0),
+    ("TOPPADDING", (0, 0), (-1, -1), 0),
+    ("BOTTOMPADDING", (0, 0), (-1, -1), 0),
+])
+
+
+def _info_table(data: Mapping[str, Any], fields: tuple) -> Table:
+    # Ячейки-строки не переносятся сами — длинные значения (адрес, телефоны) режем по ширине колонки.
+    # Пробелы и переводы строк из БД схлопываем: перенос строк в ячейке задаёт только simpleSplit
+    wrap_width = _INFO_VALUE_WIDTH - _INFO_CELL_PADDING
+    table_data = [
+        [label, "\n".join(simpleSplit(
+            " ".join(str(data.get(key, default)).split()), FONT_NAME, _INFO_FONT_SIZE, wrap_width
+        ))]
+        for label, key, default in fields
+    ]
+    return Table(
+        table_data,
+        colWidths=[_INFO_LABEL_WIDTH, _INFO_VALUE_WIDTH],
+        style=_INFO_TABLE_STYLE,
+        hAlign="LEFT",
+    )
+
+
+# Шапки таблиц разбираются один раз; Paragraph меняет своё состояние при вёрстке,
+# поэтому в каждую таблицу идут поверхностные копии (_header_row)
+_FUTURE_HEADER = tuple(Paragraph(h, _NORMAL) for h in ("Дата", "Филиал", "Доктор", "Комментарий", "Статус"))
+_COMPLEX_HEADER = tuple(Paragraph(h, _NORMAL) for h in ("Услуга", "Кол-во", "Стоимость", "Итого"))
+_APPROVED_HEADER = tuple(Paragraph(h, _NORMAL) for h in ("Услуга", "Кол-во", "Цена", "Сумма"))
 
+
+def _header_row(header: tuple) -> list:
+    return [copy.copy(cell) for cell in header]
+
+
+# Даты приёмов сильно повторяются между отчётами — кэшируем результат
+@lru_cache(maxsize=4096)
 def _format_future_date(raw: str | None) -> str:
     if not raw:
         return "—"
+    # Из БД приходит YYYY-MM-DD: разбираем без strptime и без исключений на неподходящих форматах
+    if len(raw) == 10 and raw[4] == "-" and raw[7] == "-":
+        try:
+            return date.fromisoformat(raw).strftime("%d.%m.%Y")
+        except ValueError:
+            pass
     for fmt in ("%Y-%m-%d", "%d.%m.%Y", "%Y.%m.%d", "%d-%m-%Y"):
         try:
             return datetime.strptime(raw, fmt).strftime("%d.%m.%Y")
@@ -69,19 +221,18 @@ def _resolve_report_path(
 
 
 def _render_report(data: Mapping[str, Any], report_path: Path) -> Path:
-    doc = SimpleDocTemplate(str(report_path), pagesize=A4)
-    styles = getSampleStyleSheet()
-    normal = styles["Normal"]
-    normal.fontName = FONT_NAME
-
-    title_style = ParagraphStyle(
-        "Title",
-        parent=styles["Heading1"],
-        alignment=1,
-        spaceAfter=10,
-        fontName=FONT_NAME,
-    )
-    h2_style = ParagraphStyle("H2", parent=styles["Heading2"], fontName=FONT_NAME)
+    # Через временный файл и os.replace: при сбое на месте отчёта не останется обрезанный PDF
+    write_atomic(report_path, _render_report_bytes(data))
+    return report_path
+
+
+def _render_report_bytes(data: Mapping[str, Any]) -> bytes:
+    # PDF собирается в памяти — запись на диск одним куском делает вызывающий код
+    buf = io.BytesIO()
+    doc = SimpleDocTemplate(buf, pagesize=A4)
+    normal = _NORMAL
+    title_style = _TITLE_STYLE
+    h2_style = _H2_STYLE
 
     story = []
 
@@ -90,20 +241,10 @@ def _render_report(data: Mapping[str, Any], report_path: Path) -> Path:
     story.append(Spacer(1, 12))
 
     # Основные сведения
-    story.append(Paragraph(f"<b>ФИО:</b> {data.get('ФИО', '—')}", normal))
-    story.append(Paragraph(f"<b>Дата рождения:</b> {data.get('Дата рождения', '—')}", normal))
-    story.append(Paragraph(f"<b>Адрес:</b> {data.get('Адрес', '—')}", normal))
-    story.append(Paragraph(f"<b>Телефон:</b> {data.get('Телефон', '—')}", normal))
-    story.append(Paragraph(f"<b>Email:</b> {data.get('Email', '—')}", normal))
+    story.append(_info_table(data, _PERSONAL_INFO_FIELDS))
     story.append(Spacer(1, 12))
 
-    story.append(Paragraph(f"<b>ФИО консультанта:</b> {data.get('ФИО консультанта', '—')}", normal))
-    story.append(Paragraph(f"<b>Дата первичного приёма:</b> {data.get('Дата первичного приёма', '—')}", normal))
-    story.append(Paragraph(f"<b>Доктор первичного приёма:</b> {data.get('Доктор первичного приёма', '—')}", normal))
-    story.append(Paragraph(f"<b>Статус пациента:</b> {data.get('Статус пациента', '—')}", normal))
-    story.append(Paragraph(f"<b>Тип пациента:</b> {data.get('Тип пациента', '—')}", normal))
-    story.append(Paragraph(f"<b>Текущая стадия лечения:</b> {data.get('Текущая стадия лечения', '—')}", normal))
-    story.append(Paragraph(f"<b>Количество визитов в клинику:</b> {data.get('Количество визитов в клинику', 0)}", normal))
+    story.append(_info_table(data, _CLINIC_INFO_FIELDS))
 
     story.append(Spacer(1, 12))
 
@@ -111,13 +252,7 @@ def _render_report(data: Mapping[str, Any], report_path: Path) -> Path:
     story.append(Paragraph("<b>Предстоящие приёмы:</b>", h2_style))
     future = data.get("Предстоящие приёмы", [])
     if future:
-        table_data = [[
-            Paragraph("Дата", normal),
-            Paragraph("Филиал", normal),
-            Paragraph("Доктор", normal),
-            Paragraph("Комментарий", normal),
-            Paragraph("Статус", normal),
-        ]]
+        table_data = [_header_row(_FUTURE_HEADER)]
         for r in future:
             table_data.append([
                 Paragraph(_format_future_date(r.get("Дата")), normal),
@@ -127,17 +262,7 @@ def _render_report(data: Mapping[str, Any], report_path: Path) -> Path:
                 Paragraph(r["Статус"], normal),
             ])
         table = Table(table_data, colWidths=[70, 70, 130, 150, 80], repeatRows=1)
-        table.setStyle(TableStyle([
-            ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
-            ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
-            ("FONTNAME", (0, 0), (-1, -1), FONT_NAME),
-            ("FONTSIZE", (0, 0), (-1, -1), 8),
-            ("VALIGN", (0, 0), (-1, -1), "TOP"),
-            ("ALIGN", (0, 0), (0, -1), "CENTER"),  # выравнивание даты
-            ("ALIGN", (-1, 1), (-1, -1), "CENTER"),  # выравнивание статуса
-            ("LEFTPADDING", (0, 0), (-1, -1), 3),
-            ("RIGHTPADDING", (0, 0), (-1, -1), 3),
-        ]))
+        table.setStyle(_FUTURE_TABLE_STYLE)
 
         story.append(table)
     else:
@@ -150,12 +275,7 @@ def _render_report(data: Mapping[str, Any], report_path: Path) -> Path:
     if complex_plans:
         total_all_complex = 0
         for cp in complex_plans:
-            table_data = [[
-                Paragraph("Услуга", normal),
-                Paragraph("Кол-во", normal),
-                Paragraph("Стоимость", normal),
-                Paragraph("Итого", normal),
-            ]]
+            table_data = [_header_row(_COMPLEX_HEADER)]
             for d in cp["Состав"]:
                 table_data.append([
                     Paragraph(d["name"], normal),
@@ -166,16 +286,7 @@ def _render_report(data: Mapping[str, Any], report_path: Path) -> Path:
             table_data.append(["", "", Paragraph("ИТОГО", normal), f"{cp['Итого']:,.2f}"])
 
             table = Table(table_data, colWidths=[300, 50, 70, 80], repeatRows=1)
-            table.setStyle(TableStyle([
-                ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
-                ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
-                ("FONTNAME", (0, 0), (-1, -1), FONT_NAME),
-                ("FONTSIZE", (0, 0), (-1, -1), 9),
-                ("BACKGROUND", (0, -1), (-1, -1), colors.whitesmoke),
-                ("ALIGN", (1, 1), (-1, -1), "CENTER"),
-                ("ALIGN", (2, 1), (-1, -1), "RIGHT"),
-                ("VALIGN", (0, 0), (-1, -1), "TOP"),
-            ]))
+            table.setStyle(_COMPLEX_TABLE_STYLE)
 
             block = [
                 Paragraph(f"<u>{cp['План']}</u>", normal),
@@ -200,12 +311,7 @@ def _render_report(data: Mapping[str, Any], report_path: Path) -> Path:
     if approved:
         total_all = 0
         for plan in approved:
-            table_data = [[
-                Paragraph("Услуга", normal),
-                Paragraph("Кол-во", normal),
-                Paragraph("Цена", normal),
-                Paragraph("Сумма", normal),
-            ]]
+            table_data = [_header_row(_APPROVED_HEADER)]
             for r in plan["Состав"]:
                 table_data.append([
                     Paragraph(r["name"] or "—", normal),
@@ -220,15 +326,7 @@ def _render_report(data: Mapping[str, Any], report_path: Path) -> Path:
             ])
 
             table = Table(table_data, colWidths=[300, 50, 70, 80], repeatRows=1)
-            table.setStyle(TableStyle([
-                ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
-                ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
-                ("BACKGROUND", (0, -1), (-1, -1), colors.lightgrey),
-                ("FONTNAME", (0, 0), (-1, -1), FONT_NAME),
-                ("FONTSIZE", (0, 0), (-1, -1), 8),
-                ("ALIGN", (1, 1), (-1, -1), "CENTER"),
-                ("VALIGN", (0, 0), (-1, -1), "TOP"),
-            ]))
+            table.setStyle(_APPROVED_TABLE_STYLE)
 
             block = [
                 Paragraph(f"<b>{plan['План']}</b>", normal),
@@ -260,7 +358,25 @@ def _render_report(data: Mapping[str, Any], report_path: Path) -> Path:
     # Генерация PDF
     doc.build(story)
 
-    return report_path
+    return buf.getvalue()
+
+
+def build_patient_report_bytes(
+    pcode: str,
+    *,
+    patient_data: Mapping[str, Any] | None = None,
+    conn: Any | None = None,
+    formatted: Mapping[str, Any] | None = None,
+) -> bytes:
+    if formatted is not None:
+        return _render_report_bytes(formatted)
+
+    if patient_data is None:
+        if conn is None:
+            raise ValueError("Необходимо указать либо patient_data, либо conn")
+        patient_data = collect_patient_data(conn, pcode)
+
+    return _render_report_bytes(format_patient_data(patient_data))
 
 
 def _build_patient_report(
@@ -277,7 +393,7 @@ def _build_patient_report(
         patient_data = collect_patient_data(conn, pcode)
 
     report_path = _resolve_report_path(pcode, output_dir, output_file)
-    formatted = format_patient_data(dict(patient_data))
+    formatted = format_patient_data(patient_data)
     return _render_report(formatted, report_path)
 
 
@@ -1,3 +1,14 @@
+def _plan_details(rows: list, amount_key: str) -> list[dict]:
+    # Строки плана одним списковым включением: count * amount на каждую позицию
+    return [
+        {"name": d.get("SCHNAME"),
+         "count": (count := d.get("SCOUNT") or 0),
+         "amount": (amount := d.get(amount_key) or 0),
+         "total": count * amount}
+        for d in rows
+    ]
+
+
 def format_patient_data(data: dict) -> dict:
     result = {}
 
@@ -11,7 +22,7 @@ def format_patient_data(data: dict) -> dict:
     result["Дата рождения"] = bdate.strftime("%d.%m.%Y") if bdate else "—"
     result["Адрес"] = info.get("FULL_ADDR") or "—"
     result["Телефон"] = ", ".join(
-        [t for t in [info.get("PHONE1"), info.get("PHONE2"), info.get("PHONE3")] if t]
+        t for t in (info.get("PHONE1"), info.get("PHONE2"), info.get("PHONE3")) if t
     ) or "—"
     result["Email"] = info.get("CLMAIL") or "—"
     #Филиал
@@ -27,7 +38,6 @@ def format_patient_data(data: dict) -> dict:
     result["Статус пациента"] = info.get("AGESTATUS_NAME") or "Статус не установлен"
     result["Тип пациента"] = info.get("TYPESTATUS_NAME") or "Статус не установлен"
     result["Текущая стадия лечения"] = data.get("current_stage") or "—"
-    approved_plans = data.get("approved_plans") or []
     result["Количество визитов в клинику"] = info.get("VISIT_COUNT") or 0
 
     result["Предстоящие приёмы"] = data.get("future_appointments", [])
@@ -44,43 +54,26 @@ def format_patient_data(data: dict) -> dict:
     # Комплексные планы
     complex_plans = data.get("complex_plans") or []
     pretty_complex = []
+    complex_total = 0
     for cp in complex_plans:
         header = f"{cp.get('PLANTYPENAME', '—')} ({cp.get('DEPNAME', '—')})"
-        details = []
-        total = 0
-        for d in cp.get("details", []):
-            name = d.get("SCHNAME")
-            count = d.get("SCOUNT") or 0
-            amount = d.get("ROUND") or 0
-            line_sum = count * amount
-            total += line_sum
-            details.append({"name": name,
-                            "count": count,
-                            "amount": amount,
-                            "total": line_sum})
+        details = _plan_details(cp.get("details", []), "ROUND")
+        total = sum(d["total"] for d in details)
         pretty_complex.append({"План": header, "Состав": details, "Итого": total})
+        complex_total += total
     result["Комплексные планы"] = pretty_complex
+    # Суммы по планам считаем здесь один раз — их читают и хеш, и CSV
+    result["Стоимость комплексных планов"] = complex_total
 
     # --- Согласованные планы ---
     approved_plans = data.get("approved_plans") or []
     pretty_approved = []
+    approved_total = 0
     for plan in approved_plans:
         header = f"Согласованный план ({plan.get('DEPNAME', '—')})"
-        details = []
+        details = _plan_details(plan.get("details", []), "AMOUNTRUB")
         #total = plan.get("SUMMARUB", 0) так было
-        total = 0
-        for d in plan.get("details", []):
-            name = d.get("SCHNAME")
-            count = d.get("SCOUNT") or 0
-            amount = d.get("AMOUNTRUB") or 0
-            line_sum = count * amount
-            total += line_sum
-            details.append({
-                "name": name,
-                "count": count,
-                "amount": amount,
-                "total": line_sum
-            })
+        total = sum(d["total"] for d in details)
         pretty_approved.append({
             "План": header,
             "Дата": plan.get("TREATDATE").strftime("%d.%m.%Y") if plan.get("TREATDATE") else "—",
@@ -88,7 +81,9 @@ def format_patient_data(data: dict) -> dict:
             "Состав": details,
             "Итого": total
         })
+        approved_total += total
     result["Согласованные планы"] = pretty_approved
+    result["Стоимость согласованных планов"] = approved_total
     result["Общая оплаченная сумма по согласованным планам"] = data.get("approved_plans_paid", 0)
 
     return result